@@ -29,6 +29,10 @@ int WATER_WET_RAW = 100;    // 水に触れた時の生値（高い値）
 const int WATER_LOW_THRESHOLD = 30;     // これ以下→水不足（赤）
 const int WATER_OK_THRESHOLD  = 60;     // これ以上→十分な水（緑）
 
+// === シリアル出力形式 ===
+// true にすると "R,<raw>,<pct>" の簡易形式で送信（local_sensor.py が自動判別）
+const bool COMPACT_SERIAL = false;
+
 // === 状態管理フラグ ===
 int lastWaterStatus = -1; // 前回の水分状態（-1=初期状態）
 // 状態定義: 0=赤(水不足), 1=黄(適度), 2=緑(十分)
@@ -79,12 +83,19 @@ void loop() {
   showStatusOnDisplay(waterPct, currentStatus); // ディスプレイ更新
   showTrafficLight(currentStatus); // LED更新
   
-  Serial.print("Raw: ");
-  Serial.print(rawWater);
-  Serial.print(" -> ");
-  Serial.print(waterPct);
-  Serial.print("% | 状態: ");
-  Serial.println(getWaterStatus(waterPct));
+  if (COMPACT_SERIAL) {
+    Serial.print("R,");
+    Serial.print(rawWater);
+    Serial.print(",");
+    Serial.println(waterPct);
+  } else {
+    Serial.print("Raw: ");
+    Serial.print(rawWater);
+    Serial.print(" -> ");
+    Serial.print(waterPct);
+    Serial.print("% | 状態: ");
+    Serial.println(getWaterStatus(waterPct));
+  }
   
   // 前回の状態を更新
   lastWaterStatus = currentStatus;
@@ -0,0 +1,202 @@
+"""AquaSync 読み取り値の永続ストア
+
+読み取り値をSQLite（WALモード）にまとめて書き込み、分・時・日ごとの
+最小/最大/平均をロールアップテーブルに逐次集計する。
+生データとロールアップはそれぞれの保存期間を過ぎたら削除する。
+"""
+import queue
+import sqlite3
+import threading
+import time
+
+# (テーブル名, バケット幅[秒])
+ROLLUPS = (
+    ('rollup_minute', 60),
+    ('rollup_hour', 3600),
+    ('rollup_day', 86400),
+)
+
+class ReadingStore:
+    """読み取り値の時系列ストア"""
+
+    def __init__(self, path, retention, batch_size=200, flush_interval=1.0):
+        """retention は {'raw': 秒, 'rollup_minute': 秒, ...}（0 は無期限）"""
+        self.path = path
+        self.retention = retention
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._last_retention = 0
+        self._local = threading.local()
+
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS readings ('
+            ' ts REAL NOT NULL, raw INTEGER, percentage INTEGER NOT NULL, status TEXT)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS readings_ts ON readings (ts)')
+        for table, _ in ROLLUPS:
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} ('
+                ' bucket INTEGER PRIMARY KEY, count INTEGER NOT NULL,'
+                ' pct_sum REAL NOT NULL, pct_min INTEGER NOT NULL, pct_max INTEGER NOT NULL,'
+                ' raw_sum REAL NOT NULL, status TEXT)'
+            )
+
+        self._writer = threading.Thread(target=self._run, name='reading-store', daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        """スレッドごとの接続を返す"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def add(self, timestamp, raw_value, percentage, status):
+        """読み取り値を書き込み待ちに追加（書き込みは別スレッドでまとめて行う）"""
+        self._queue.put((timestamp, raw_value, percentage, status))
+
+    def _run(self):
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(rows)
+                if time.time() - self._last_retention >= 3600:
+                    self.enforce_retention()
+            except Exception as e:
+                print(f"履歴保存エラー: {e}")
+
+    def _write(self, rows):
+        """生データの一括挿入とロールアップの加算を1トランザクションで行う"""
+        conn = self._connect()
+        conn.execute('BEGIN')
+        try:
+            conn.executemany('INSERT INTO readings (ts, raw, percentage, status) VALUES (?, ?, ?, ?)', rows)
+            for table, width in ROLLUPS:
+                # 同じバケットの行は先にまとめてから書き込む
+                buckets = {}
+                for ts, raw, pct, status in rows:
+                    bucket = int(ts // width) * width
+                    entry = buckets.get(bucket)
+                    if entry is None:
+                        buckets[bucket] = [1, pct, pct, pct, raw or 0, status]
+                    else:
+                        entry[0] += 1
+                        entry[1] += pct
+                        entry[2] = min(entry[2], pct)
+                        entry[3] = max(entry[3], pct)
+                        entry[4] += raw or 0
+                        entry[5] = status
+                conn.executemany(
+                    f'INSERT INTO {table} (bucket, count, pct_sum, pct_min, pct_max, raw_sum, status)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)'
+                    ' ON CONFLICT(bucket) DO UPDATE SET'
+                    ' count = count + excluded.count,'
+                    ' pct_sum = pct_sum + excluded.pct_sum,'
+                    ' pct_min = MIN(pct_min, excluded.pct_min),'
+                    ' pct_max = MAX(pct_max, excluded.pct_max),'
+                    ' raw_sum = raw_sum + excluded.raw_sum,'
+                    ' status = excluded.status',
+                    [(bucket, *entry) for bucket, entry in buckets.items()],
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def enforce_retention(self):
+        """保存期間を過ぎた生データとロールアップを削除"""
+        self._last_retention = time.time()
+        conn = self._connect()
+        now = time.time()
+        if self.retention.get('raw'):
+            conn.execute('DELETE FROM readings WHERE ts < ?', (now - self.retention['raw'],))
+        for table, _ in ROLLUPS:
+            if self.retention.get(table):
+                conn.execute(f'DELETE FROM {table} WHERE bucket < ?', (now - self.retention[table],))
+
+    def recent(self, since):
+        """since 以降の生データを古い順に返す（起動時の履歴復元用）"""
+        return self._connect().execute(
+            'SELECT ts, raw, percentage, status FROM readings WHERE ts >= ? ORDER BY ts', (since,)
+        ).fetchall()
+
+    def _source_for(self, start, end, points):
+        """必要な解像度と保存期間から読み出すテーブルを選ぶ
+
+        期間の始まりまでデータが残っている層のうち、バケット幅が
+        1点あたりの秒数を超えない最も粗い層を使う。
+        """
+        step = (end - start) / points
+        now = time.time()
+        tiers = [('readings', 0, self.retention.get('raw'))]
+        tiers += [(table, width, self.retention.get(table)) for table, width in ROLLUPS]
+        available = [(table, width) for table, width, retention in tiers
+                     if not retention or start >= now - retention]
+        if not available:
+            return ROLLUPS[-1]
+        chosen = available[0]
+        for table, width in available:
+            if width <= step:
+                chosen = (table, width)
+        return chosen
+
+    def query(self, start, end, points):
+        """期間 [start, end] を最大points個のバケットに集計して返す
+
+        長い期間は生データを走査せず、解像度の合うロールアップから集計する。
+        各バケットの状態は最後の行のものを、相関サブクエリで同じ文の中で引く。
+        """
+        table, width = self._source_for(start, end, points)
+        bucket_width = max((end - start) / points, width or 1e-9)
+        conn = self._connect()
+        if table == 'readings':
+            rows = conn.execute(
+                'SELECT first_ts, pct_min, pct_max, pct_avg, raw_avg,'
+                ' (SELECT status FROM readings WHERE ts = last_ts LIMIT 1)'
+                ' FROM (SELECT CAST((ts - ?) / ? AS INTEGER) AS slot, MIN(ts) AS first_ts,'
+                '  MIN(percentage) AS pct_min, MAX(percentage) AS pct_max,'
+                '  AVG(percentage) AS pct_avg, AVG(raw) AS raw_avg, MAX(ts) AS last_ts'
+                '  FROM readings WHERE ts BETWEEN ? AND ? GROUP BY slot)'
+                ' ORDER BY slot',
+                (start, bucket_width, start, end),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                f'SELECT first_ts, pct_min, pct_max, pct_avg, raw_avg,'
+                f' (SELECT status FROM {table} WHERE bucket = last_bucket)'
+                f' FROM (SELECT CAST((bucket - ?) / ? AS INTEGER) AS slot, MIN(bucket) AS first_ts,'
+                f'  MIN(pct_min) AS pct_min, MAX(pct_max) AS pct_max,'
+                f'  SUM(pct_sum) / SUM(count) AS pct_avg, SUM(raw_sum) / SUM(count) AS raw_avg,'
+                f'  MAX(bucket) AS last_bucket'
+                f'  FROM {table} WHERE bucket BETWEEN ? AND ? GROUP BY slot)'
+                f' ORDER BY slot',
+                (start, bucket_width, start - width, end),
+            ).fetchall()
+
+        # HistoryBuffer.query と同じ形にそろえる
+        series = [
+            {
+                't': first_ts,
+                'min': pct_min,
+                'max': pct_max,
+                'avg': round(pct_avg, 1),
+                'raw': round(raw_avg) if raw_avg is not None else None,
+                'status': status,
+            }
+            for first_ts, pct_min, pct_max, pct_avg, raw_avg, status in rows
+        ]
+        return table, series
@@ -0,0 +1,24 @@
+"""AquaSync Gunicorn設定
+
+`gunicorn web_dashboard:app` の実行時に自動で読み込まれる。
+/api/stream や /api/data?wait_for= は接続を長時間保持するため、
+接続ごとにスレッドを消費しない gevent ワーカーを使う。
+"""
+import os
+
+try:
+    import gevent  # noqa: F401
+    worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+except ImportError:
+    # gevent がない環境ではスレッドワーカーで代用
+    worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+if worker_class == 'gthread':
+    threads = int(os.getenv('GUNICORN_THREADS', '32'))
+
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+if workers > 1:
+    # 現在データをワーカー間で共有する（state_backend.py 参照）
+    os.environ.setdefault('STATE_BACKEND', 'mmap')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = 10
@@ -0,0 +1,114 @@
+"""AquaSync 履歴データのリングバッファ
+
+読み取り値を1件ずつdictで持たず、項目ごとの固定長 array に保持する。
+容量を超えたら最も古いサンプルから上書きする。
+"""
+import threading
+from array import array
+
+STATUS_CODES = {'unknown': 0, 'red': 1, 'yellow': 2, 'green': 3}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+
+class HistoryBuffer:
+    """(timestamp, raw, percentage, status) の固定長リングバッファ"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.raw_values = array('i', bytes(4 * capacity))
+        self.percentages = array('h', bytes(2 * capacity))
+        self.statuses = array('b', bytes(capacity))
+        self.dropped = 0  # 時系列順にならないため捨てたサンプル数
+        self._start = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def oldest(self):
+        """保持している最も古いサンプルの時刻（空ならNone）"""
+        with self._lock:
+            return self.timestamps[self._start] if self._size else None
+
+    def append(self, timestamp, raw_value, percentage, status):
+        """サンプルを1件追加（直前より古い時刻のサンプルは捨てる）"""
+        with self._lock:
+            if self._size and timestamp < self.timestamps[(self._start + self._size - 1) % self.capacity]:
+                self.dropped += 1
+                return False
+            if self._size < self.capacity:
+                index = (self._start + self._size) % self.capacity
+                self._size += 1
+            else:
+                index = self._start
+                self._start = (self._start + 1) % self.capacity
+            self.timestamps[index] = timestamp
+            self.raw_values[index] = int(raw_value)
+            self.percentages[index] = int(percentage)
+            self.statuses[index] = STATUS_CODES.get(status, 0)
+            return True
+
+    def _bisect(self, timestamp, right=False):
+        """timestamp以上（right=Trueなら超える）最初の論理インデックス"""
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            value = self.timestamps[(self._start + middle) % self.capacity]
+            if value < timestamp or (right and value == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _columns(self, first, last):
+        """論理インデックス [first, last) の各列を連続した array として取り出す"""
+        begin = (self._start + first) % self.capacity
+        end = begin + (last - first)
+        columns = []
+        for column in (self.timestamps, self.raw_values, self.percentages, self.statuses):
+            if end <= self.capacity:
+                columns.append(column[begin:end])
+            else:
+                columns.append(column[begin:] + column[:end - self.capacity])
+        return columns
+
+    def query(self, start, end, points):
+        """期間 [start, end] のサンプルを最大points個のバケットに間引いて返す
+
+        各バケットは水分%の最小・最大・平均と、最後のサンプルの生値・状態を持つ。
+        """
+        with self._lock:
+            first = self._bisect(start)
+            last = self._bisect(end, right=True)
+            timestamps, raw_values, percentages, statuses = self._columns(first, last)
+
+        count = len(timestamps)
+        if count <= points:
+            return [
+                {
+                    't': timestamps[i],
+                    'min': percentages[i],
+                    'max': percentages[i],
+                    'avg': percentages[i],
+                    'raw': raw_values[i],
+                    'status': STATUS_NAMES[statuses[i]],
+                }
+                for i in range(count)
+            ]
+
+        # 件数で等分したバケットごとに最小・最大・平均を array のスライスで計算
+        series = []
+        for bucket in range(points):
+            begin = bucket * count // points
+            stop = (bucket + 1) * count // points
+            values = percentages[begin:stop]
+            series.append({
+                't': timestamps[begin],
+                'min': min(values),
+                'max': max(values),
+                'avg': round(sum(values) / len(values), 1),
+                'raw': raw_values[stop - 1],
+                'status': STATUS_NAMES[statuses[stop - 1]],
+            })
+        return series
@@ -0,0 +1,156 @@
+"""AquaSync 共通HTTPトランスポート
+
+local_sensor.py と local_sensor_test.py から使う共有セッション。
+ホストごとにkeep-aliveの接続プールを持ち、接続/読み取りタイムアウトと
+リトライ回数を明示的に設定する。新規接続数を数えて接続の再利用率を確認できる。
+"""
+import os
+import threading
+from urllib.parse import urlsplit
+
+# 設定
+CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '10'))
+POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '4'))
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# 接続統計（ホスト名 -> カウンタ）
+_stats = {}
+_stats_lock = threading.Lock()
+
+def _count(host, key):
+    with _stats_lock:
+        counters = _stats.setdefault(host, {'requests': 0, 'new_connections': 0, 'reused_connections': 0})
+        counters[key] += 1
+
+def _adapter_class():
+    """既定タイムアウトと接続数カウント付きのアダプタクラスを作成
+
+    requests/urllib3 の読み込みに時間がかかるので、最初の通信まで読み込まない。
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class CountingPoolMixin:
+        """応答を受け取れた送信ごとに、新規接続か再利用かを数える
+
+        接続オブジェクトの作成時ではなく送信の成否で数えるので、
+        接続に失敗した試行やリトライで捨てた接続は新規接続に含めない。
+        """
+
+        def _make_request(self, conn, *args, **kwargs):
+            fresh = conn.sock is None  # 未接続なら、この送信で新しく接続する
+            response = super()._make_request(conn, *args, **kwargs)
+            _count(self.host, 'new_connections' if fresh else 'reused_connections')
+            return response
+
+    class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+        """新規TCP接続を数えるHTTP接続プール"""
+
+    class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+        """新規TCP+TLS接続を数えるHTTPS接続プール"""
+
+    class TransportAdapter(HTTPAdapter):
+        """既定タイムアウトと接続数カウント付きのアダプタ"""
+
+        def __init__(self, timeout=None, **kwargs):
+            self.timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+            super().__init__(**kwargs)
+
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {
+                'http': CountingHTTPConnectionPool,
+                'https': CountingHTTPSConnectionPool,
+            }
+
+        def send(self, request, timeout=None, **kwargs):
+            _count(urlsplit(request.url).hostname, 'requests')
+            return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+    return TransportAdapter
+
+def make_retry(retries, retry_on_status=True):
+    """リトライ方針を作成
+
+    retry_on_status=False の場合は接続失敗のみ再試行する（重複送信を避けたいLINE向け）。
+    """
+    from urllib3.util.retry import Retry
+
+    if retry_on_status:
+        return Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=False,  # POSTも再試行する
+            backoff_factor=0.5,
+            raise_on_status=False,
+        )
+    return Retry(total=retries, connect=retries, read=0, status=0, backoff_factor=0.5)
+
+_session = None
+_session_lock = threading.Lock()
+_adapter = None
+_hosts = {}  # URLの接頭辞 -> (タイムアウト, リトライ回数, retry_on_status)
+
+def _mount_host(session, prefix, timeout, retries, retry_on_status):
+    session.mount(prefix, _adapter(
+        timeout=timeout,
+        pool_connections=1,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=make_retry(retries, retry_on_status),
+    ))
+
+def get_session():
+    """共有セッションを初回だけ作成して返す（configure_host の設定もここで反映）"""
+    global _session, _adapter
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+
+                _adapter = _adapter_class()
+                session = requests.Session()
+                session.mount('http://', _adapter(pool_maxsize=POOL_MAXSIZE, max_retries=make_retry(1)))
+                session.mount('https://', _adapter(pool_maxsize=POOL_MAXSIZE, max_retries=make_retry(1)))
+                for prefix, settings in _hosts.items():
+                    _mount_host(session, prefix, *settings)
+                _session = session
+    return _session
+
+def configure_host(base_url, retries=2, retry_on_status=True, connect_timeout=None, read_timeout=None):
+    """ホストごとのタイムアウトとリトライ回数を設定"""
+    parts = urlsplit(base_url)
+    prefix = f"{parts.scheme}://{parts.netloc}/"
+    settings = ((connect_timeout or CONNECT_TIMEOUT, read_timeout or READ_TIMEOUT), retries, retry_on_status)
+    with _session_lock:
+        _hosts[prefix] = settings
+        if _session is not None:
+            _mount_host(_session, prefix, *settings)
+
+def request(method, url, **kwargs):
+    """共有セッションでリクエストを送信"""
+    return get_session().request(method, url, **kwargs)
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+def get_stats():
+    """ホストごとのリクエスト数と、リトライを含む送信で使った新規接続数・再利用数を返す"""
+    with _stats_lock:
+        return {host: dict(counters) for host, counters in _stats.items()}
+
+def format_stats():
+    """接続統計を1行ずつの文字列にする"""
+    lines = []
+    for host, counters in sorted(get_stats().items()):
+        lines.append(
+            f"{host}: リクエスト {counters['requests']} / 新規接続 {counters['new_connections']}"
+            f" / 再利用 {counters['reused_connections']}"
+        )
+    return "\n".join(lines) or "通信なし"
@@ -0,0 +1,119 @@
+"""AquaSync 画像の軽量版（レスポンシブ用バリアント）生成
+
+img/ 以下の画像から、幅ごと・形式（AVIF/WebP）ごとの縮小版を作って
+キャッシュディレクトリに保存する。ファイル名に元画像と設定のハッシュを含めるので、
+一度作ったものは再利用され、画像を差し替えれば別名で作り直される。
+
+ビルド時に `python image_variants.py` で事前生成できる。
+Pillow がない環境ではバリアントを作らず、元画像だけを使う。
+"""
+import hashlib
+import json
+import os
+import sys
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+# 設定
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_DIR = os.path.join(BASE_DIR, 'img')
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', os.path.join(BASE_DIR, '.image_cache'))
+IMAGE_WIDTHS = [int(w) for w in os.getenv('IMAGE_WIDTHS', '320,480,800,960,1280,1920').split(',') if w.strip()]
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MANIFEST_NAME = 'manifest.json'
+
+# (MIMEタイプ, 拡張子, Pillowの形式名, 保存オプション) を優先度順に
+FORMATS = (
+    ('image/avif', 'avif', 'AVIF', {'quality': 50, 'speed': 8}),
+    ('image/webp', 'webp', 'WEBP', {'quality': 80, 'method': 4}),
+)
+
+def available_formats():
+    """このPillowで書き出せる形式だけを返す"""
+    if Image is None:
+        return []
+    return [fmt for fmt in FORMATS if features.check(fmt[1])]
+
+def _variant_widths(source_width):
+    """元画像の幅を超えない候補幅（元の幅は必ず含める）"""
+    return sorted({w for w in IMAGE_WIDTHS if w < source_width} | {source_width})
+
+def build_variants(image_dir=IMAGE_DIR, cache_dir=IMAGE_CACHE_DIR):
+    """全画像のバリアントを生成（既にあるものは再利用）してマニフェストを返す
+
+    マニフェストは {元ファイル名: {'width': 幅, 'height': 高さ, 'sources': {MIMEタイプ: [[名前, 幅], ...]}}}
+    """
+    formats = available_formats()
+    if not formats:
+        return {}
+    os.makedirs(cache_dir, exist_ok=True)
+
+    manifest = {}
+    created = 0
+    for filename in sorted(os.listdir(image_dir)):
+        stem, ext = os.path.splitext(filename)
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        with open(os.path.join(image_dir, filename), 'rb') as f:
+            data = f.read()
+        digest = hashlib.blake2b(data, digest_size=16)
+
+        with Image.open(os.path.join(image_dir, filename)) as source:
+            source.load()
+            width, height = source.size
+            sources = {}
+            for mimetype, extension, pil_format, options in formats:
+                variants = []
+                for target_width in _variant_widths(width):
+                    key = digest.copy()
+                    key.update(f"{target_width}:{pil_format}:{sorted(options.items())}".encode())
+                    name = f"{stem}-{target_width}w-{key.hexdigest()[:12]}.{extension}"
+                    path = os.path.join(cache_dir, name)
+                    if not os.path.exists(path):
+                        target_height = max(1, round(height * target_width / width))
+                        image = source if target_width == width else source.resize(
+                            (target_width, target_height), Image.LANCZOS)
+                        # 書き込み途中のファイルを配信しないよう一時ファイル経由で置き換える
+                        tmp_path = f"{path}.{os.getpid()}.tmp"
+                        image.save(tmp_path, pil_format, **options)
+                        os.replace(tmp_path, path)
+                        created += 1
+                    variants.append([name, target_width])
+                sources[mimetype] = variants
+            manifest[filename] = {'width': width, 'height': height, 'sources': sources}
+
+    tmp_path = os.path.join(cache_dir, f"{MANIFEST_NAME}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(cache_dir, MANIFEST_NAME))
+    if created:
+        print(f"🖼️ 画像バリアントを生成: {created}件")
+    return manifest
+
+def load_manifest(cache_dir=IMAGE_CACHE_DIR):
+    """生成済みのマニフェストを読み込む（なければNone）"""
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+if __name__ == '__main__':
+    if Image is None:
+        print("❌ Pillow がインストールされていません（pip install Pillow）")
+        sys.exit(1)
+    manifest = build_variants()
+    original = sum(os.path.getsize(os.path.join(IMAGE_DIR, name)) for name in manifest)
+    print(f"📁 出力先: {IMAGE_CACHE_DIR}")
+    for filename, entry in manifest.items():
+        sizes = []
+        for mimetype, variants in entry['sources'].items():
+            name, width = variants[-1]
+            kb = os.path.getsize(os.path.join(IMAGE_CACHE_DIR, name)) / 1024
+            sizes.append(f"{mimetype.split('/')[1]} {width}w {kb:.0f}KB")
+        source_kb = os.path.getsize(os.path.join(IMAGE_DIR, filename)) / 1024
+        print(f"  {filename} ({source_kb:.0f}KB): " + ", ".join(sizes))
+    print(f"✅ {len(manifest)}枚の画像を処理しました（元画像合計 {original / 1024:.0f}KB）")
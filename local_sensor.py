@@ -1,19 +1,98 @@
-import requests
+# 起動時間の内訳表示用。ライブラリの読み込みも含めて測るため、他の import より先に記録する
+import time
+_STARTED = time.perf_counter()
+
 import serial
 import os
-import time
+import re
+import queue
+import selectors
 import threading
-from dotenv import load_dotenv
+from collections import deque
+from statistics import median_low
+from contextlib import contextmanager
 from datetime import datetime
+from dotenv import load_dotenv
+
+import http_transport
+import metrics
+from message_cache import MessageCache, PLACEHOLDER
+from sensor_outbox import SensorOutbox
 
 load_dotenv()
 
 # 設定
 CHANNEL_ACCESS_TOKEN = os.getenv('CHANNEL_ACCESS_TOKEN')
 ARDUINO_PORT = os.getenv('ARDUINO_PORT')
+ARDUINO_PORTS = os.getenv('ARDUINO_PORTS', '')  # 複数台監視: "pot1=/dev/ttyACM0,pot2=/dev/ttyACM1"
+DEVICE_ID = os.getenv('DEVICE_ID')  # 1台監視時にクラウド送信へ付けるID（任意）
+DEVICE_THRESHOLDS = os.getenv('DEVICE_THRESHOLDS', '')  # 台ごとのしきい値: "pot2=25:55"
+WATER_LOW_THRESHOLD = int(os.getenv('WATER_LOW_THRESHOLD', '30'))  # これ以下→水不足（赤）
+WATER_OK_THRESHOLD = int(os.getenv('WATER_OK_THRESHOLD', '60'))  # これを超える→十分（緑）
+STATUS_HYSTERESIS = float(os.getenv('STATUS_HYSTERESIS', '3'))  # しきい値をこの%以上越えたら状態を切り替える
+STATUS_MIN_DWELL = float(os.getenv('STATUS_MIN_DWELL', '30'))  # 状態が変わってから次に変えるまでの最短秒数
+NOTIFY_DIGEST_WINDOW = float(os.getenv('NOTIFY_DIGEST_WINDOW', '300'))  # この秒数内の状態変化通知を1通にまとめる
+REPORT_INTERVAL = int(os.getenv('REPORT_INTERVAL', '600'))  # 定期レポート間隔（秒）
+CLOUD_UPDATE_INTERVAL = int(os.getenv('CLOUD_UPDATE_INTERVAL', '10'))  # クラウド更新間隔（秒）
+SERIAL_BAUDRATE = int(os.getenv('SERIAL_BAUDRATE', '9600'))
+SERIAL_READ_TIMEOUT = float(os.getenv('SERIAL_READ_TIMEOUT', '0.5'))  # 1回の読み取りで待つ最大秒数
+SERIAL_CHUNK_SIZE = int(os.getenv('SERIAL_CHUNK_SIZE', '4096'))  # 1回に読み込む最大バイト数
+SERIAL_MAX_LINE = int(os.getenv('SERIAL_MAX_LINE', '1024'))  # 改行なしでこれを超えたら破棄
+SERIAL_STATS_INTERVAL = int(os.getenv('SERIAL_STATS_INTERVAL', '300'))  # 受信統計の表示間隔（秒、0で無効）
+SERIAL_ECHO = os.getenv('SERIAL_ECHO', '1') == '1'  # 受信した行をそのまま表示するか
+READING_FILTER = os.getenv('READING_FILTER', 'median')  # 読み取り値の平滑化: ewma / median / none
+READING_EWMA_ALPHA = float(os.getenv('READING_EWMA_ALPHA', '0.5'))  # ewma: 新しい値の重み（1で平滑化なし）
+READING_MEDIAN_WINDOW = int(os.getenv('READING_MEDIAN_WINDOW', '5'))  # median: 直近何件の中央値を使うか
+READING_DEADBAND = float(os.getenv('READING_DEADBAND', '1'))  # 前回処理した値からこの%以上動いたら処理する（0で毎回）
+READING_HEARTBEAT = float(os.getenv('READING_HEARTBEAT', '60'))  # 変化がなくてもこの秒数ごとに処理する
+ARDUINO_READY_TIMEOUT = float(os.getenv('ARDUINO_READY_TIMEOUT', '5'))  # 接続後に起動バナーを待つ最大秒数
 CLOUD_API_URL = os.getenv('CLOUD_API_URL', 'https://your-render-app.onrender.com')
 API_SECRET_KEY = os.getenv('API_SECRET_KEY', 'your-secret-api-key')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL_NAME', 'gemini-1.5-flash')
+GEMINI_API_ENDPOINT = os.getenv('GEMINI_API_ENDPOINT')  # ベンチマーク用の代替エンドポイント（任意）
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '8'))  # セリフ生成1回あたりの待ち時間上限（秒）
+GEMINI_WORKERS = int(os.getenv('GEMINI_WORKERS', '2'))
+GEMINI_QUEUE_SIZE = int(os.getenv('GEMINI_QUEUE_SIZE', '32'))  # 生成待ちの依頼の上限
+GEMINI_RETRY_BACKOFF = float(os.getenv('GEMINI_RETRY_BACKOFF', '30'))  # 生成に失敗した依頼を出し直すまでの待ち（秒、失敗が続くと倍々）
+GEMINI_RETRY_BACKOFF_MAX = float(os.getenv('GEMINI_RETRY_BACKOFF_MAX', '1800'))  # 出し直し待ちの上限（秒）
+MESSAGE_CACHE_PATH = os.getenv('MESSAGE_CACHE_PATH', 'aquasync_messages.json')  # セリフキャッシュの保存先（空で無効）
+MESSAGE_CACHE_TTL = float(os.getenv('MESSAGE_CACHE_TTL', str(24 * 3600)))  # この秒数を過ぎた区間は裏で作り直す
+MESSAGE_CACHE_MAX_KEYS = int(os.getenv('MESSAGE_CACHE_MAX_KEYS', '64'))  # 保持する (状態, 区間) の数
+MESSAGE_BUCKET_SIZE = int(os.getenv('MESSAGE_BUCKET_SIZE', '10'))  # 水分レベルの区間の幅（%）
+MESSAGE_BATCH_SIZE = int(os.getenv('MESSAGE_BATCH_SIZE', '12'))  # 1回のGemini呼び出しで作るセリフ数
+LINE_API_BASE = os.getenv('LINE_API_BASE', 'https://api.line.me')
+LINE_TIMEOUT = float(os.getenv('LINE_TIMEOUT', '10'))
+CLOUD_TIMEOUT = float(os.getenv('CLOUD_TIMEOUT', '10'))
+OUTBOUND_QUEUE_SIZE = int(os.getenv('OUTBOUND_QUEUE_SIZE', '50'))  # 宛先ごとの送信待ち上限
+CLOUD_BATCH_MODE = os.getenv('CLOUD_BATCH_MODE', '0') == '1'  # 読み取り値をまとめてクラウド送信
+CLOUD_BATCH_SIZE = int(os.getenv('CLOUD_BATCH_SIZE', '20'))  # この件数たまったら送信
+CLOUD_BATCH_MAX_AGE = float(os.getenv('CLOUD_BATCH_MAX_AGE', '30'))  # 最古の値がこの秒数を超えたら送信
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', 'aquasync_outbox.db')  # 未送信データの保存先
+OUTBOX_MAX_ROWS = int(os.getenv('OUTBOX_MAX_ROWS', '50000'))
+OUTBOX_MAX_AGE_HOURS = float(os.getenv('OUTBOX_MAX_AGE_HOURS', '72'))
+OUTBOX_REPLAY_BATCH = int(os.getenv('OUTBOX_REPLAY_BATCH', '200'))  # 再送1回あたりの件数
+OUTBOX_REPLAY_RATE = float(os.getenv('OUTBOX_REPLAY_RATE', '500'))  # 再送の上限（件/秒）
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9101'))  # /metrics を出すローカルポート（0で無効）
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# メトリクス（METRICS_PORT の /metrics で出力）
+EXTERNAL_DURATION = metrics.histogram(
+    'aquasync_external_request_duration_seconds', '外部API呼び出しの所要時間', ('service',))
+EXTERNAL_ERRORS = metrics.counter('aquasync_external_errors_total', '外部API呼び出しの失敗数', ('service',))
+SERIAL_BYTES = metrics.counter('aquasync_serial_bytes_total', 'シリアル受信バイト数', ('device',))
+SERIAL_LINES = metrics.counter('aquasync_serial_lines_total', 'シリアル受信行数', ('device',))
+SERIAL_LINE_RATE = metrics.gauge('aquasync_serial_lines_per_second', '直近の計測区間の受信行数/秒', ('device',))
+PARSE_FAILURES = metrics.counter('aquasync_parse_failures_total', 'データ行の形式に合わなかった行数', ('device',))
+READINGS = metrics.counter('aquasync_readings_total', '解析できた読み取り値の件数', ('device',))
+READINGS_SUPPRESSED = metrics.counter(
+    'aquasync_readings_suppressed_total', '変化が小さいため後段の処理を省いた読み取り値の件数', ('device',))
+MESSAGE_CACHE_LOOKUPS = metrics.counter('aquasync_message_cache_total', 'セリフキャッシュの参照結果', ('result',))
+
+# 外部APIはホストごとのkeep-alive接続を使い回す
+# LINEは重複配信を避けるため接続失敗時のみ再試行する
+http_transport.configure_host(CLOUD_API_URL, retries=2, read_timeout=CLOUD_TIMEOUT)
+http_transport.configure_host(LINE_API_BASE, retries=2, retry_on_status=False, read_timeout=LINE_TIMEOUT)
 
 # ローカルデータ保存
 current_data = {
@@ -26,19 +105,40 @@ current_data = {
     'character_face': 'normal'
 }
 
-def generate_character_message(percentage, status):
-    """Gemini APIを使って植物キャラクターのセリフを生成"""
-    if not GEMINI_API_KEY:
-        return get_default_message(status, percentage)
-    
-    try:
-        import google.generativeai as genai
-        
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        
-        # 明るくて親しみやすい植物キャラクター用プロンプト
-        prompt = f"""
+# Geminiモデルは1度だけ生成して使い回す
+_gemini_model = None
+_gemini_model_lock = threading.Lock()
+
+def get_gemini_model():
+    """GenerativeModelを初回だけ生成して返す"""
+    global _gemini_model
+    if _gemini_model is None:
+        with _gemini_model_lock:
+            if _gemini_model is None:
+                import google.generativeai as genai
+                
+                if GEMINI_API_ENDPOINT:
+                    genai.configure(api_key=GEMINI_API_KEY, transport='rest',
+                                    client_options={'api_endpoint': GEMINI_API_ENDPOINT})
+                else:
+                    genai.configure(api_key=GEMINI_API_KEY)
+                _gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return _gemini_model
+
+def call_gemini(prompt, timeout=GEMINI_TIMEOUT):
+    """Gemini APIにプロンプトを送り、応答テキストを返す（失敗・timeout秒超過時は例外を送出）"""
+    with EXTERNAL_DURATION.time(service='gemini'):
+        try:
+            response = get_gemini_model().generate_content(prompt, request_options={'timeout': timeout})
+            return response.text.strip()
+        except Exception:
+            EXTERNAL_ERRORS.inc(service='gemini')
+            raise
+
+def request_gemini_message(percentage, status, timeout=GEMINI_TIMEOUT):
+    """Gemini APIにセリフを1つ生成させる（失敗時は例外を送出）"""
+    # 明るくて親しみやすい植物キャラクター用プロンプト
+    prompt = f"""
 あなたは明るくて親しみやすい植物キャラクターです。
 現在の水分レベル: {percentage}%
 状態: {status}
@@ -57,20 +157,193 @@ def generate_character_message(percentage, status):
 
 セリフのみを返してください:
 """
+    
+    message = call_gemini(prompt, timeout)
+    
+    # 長いメッセージの場合は適切にトリミング
+    if len(message) > 80:
+        message = message[:77] + "..."
         
-        response = model.generate_content(prompt)
-        message = response.text.strip()
-        
-        # 長いメッセージの場合は適切にトリミング
-        if len(message) > 80:
-            message = message[:77] + "..."
-            
-        return message
-        
+    return message
+
+# 箇条書きの記号・番号や括弧を取り除いてセリフだけにする
+_MESSAGE_LINE_PREFIX = re.compile(r'^\s*(?:[-・*•]|\d+[.)．、）])\s*')
+
+def request_gemini_messages(low, high, status, count=MESSAGE_BATCH_SIZE, timeout=GEMINI_TIMEOUT):
+    """水分レベル low〜high% 用のセリフを1回の呼び出しでまとめて生成（失敗時は例外を送出）"""
+    prompt = f"""
+あなたは明るくて親しみやすい植物キャラクターです。
+水分レベル: {low}〜{high}%
+状態: {status}
+
+この状態で言うセリフを{count}個、1行に1つずつ作ってください：
+- それぞれ30-60文字程度の短いセリフ
+- 明るくて親しみやすい話し方
+- 「〜だよ」「〜ね」「〜よ」などの自然な語尾
+- 感謝の気持ちを素直に表現
+- 水分レベルの数値を入れるときは {PLACEHOLDER} と書く（例: 「{PLACEHOLDER}%で元気だよ！」）
+- 絵文字・番号・記号は付けない
+- 同じ言い回しを繰り返さない
+
+セリフのみを{count}行で返してください:
+"""
+    
+    messages = []
+    for line in call_gemini(prompt, timeout).splitlines():
+        message = _MESSAGE_LINE_PREFIX.sub('', line).strip().strip('「」"\'')
+        if message and len(message) <= 80 and message not in messages:
+            messages.append(message)
+    if not messages:
+        raise ValueError('Gemini returned no usable messages')
+    return messages[:count]
+
+def generate_character_message(percentage, status):
+    """Gemini APIを使って植物キャラクターのセリフを生成"""
+    if not GEMINI_API_KEY:
+        return get_default_message(status, percentage)
+    
+    try:
+        return request_gemini_message(percentage, status)
     except Exception as e:
         print(f"Gemini API エラー: {e}")
         return get_default_message(status, percentage)
 
+class CharacterMessageWorker:
+    """セリフ生成をシリアル読み取りループから切り離すバックグラウンドワーカー
+    
+    同じ状態への生成依頼は実行中の1件にまとめ、API呼び出しはGEMINI_TIMEOUT秒で
+    打ち切る。依頼からGEMINI_TIMEOUT秒を超えた結果は破棄し、置き換えられた依頼は
+    APIを呼ばずに捨てる。生成待ちは queue_size 件まで。
+    生成に失敗した依頼は GEMINI_RETRY_BACKOFF 秒（失敗が続くと倍々で最大
+    GEMINI_RETRY_BACKOFF_MAX 秒）出し直さず、その間はデフォルトのセリフを返す。
+    呼び出し側には常に手元のメッセージを即座に返す。
+    セリフキャッシュがあれば (状態, 区間) ごとにまとめて生成したセリフから選び、
+    キャッシュにない・古くなった区間だけを裏で生成し直す。
+    """
+    
+    def __init__(self, budget=GEMINI_TIMEOUT, workers=GEMINI_WORKERS, cache=None, queue_size=GEMINI_QUEUE_SIZE):
+        self.budget = budget
+        self.workers = max(1, workers)
+        self.cache = cache
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._lock = threading.Lock()
+        self._in_flight = {}  # 依頼のキー -> (token, 依頼時刻)
+        self._failures = {}   # 依頼のキー -> (連続失敗回数, 出し直せる時刻)
+        self._latest = {}     # status -> 最後に生成できたセリフ
+        self._threads = []
+    
+    def _ensure_started(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'gemini-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def _submit(self, key, percentage, status):
+        """生成を依頼（ロック取得済みで呼ぶ）。新しく依頼したらTrue"""
+        if not GEMINI_API_KEY:
+            return False
+        now = time.monotonic()
+        failure = self._failures.get(key)
+        if failure is not None and now < failure[1]:
+            return False  # 失敗直後は有料の呼び出しを繰り返さない
+        entry = self._in_flight.get(key)
+        # 実行中・待機中の依頼があれば相乗りする（期限切れなら見捨てて出し直す）
+        # キャッシュの生成は待ち時間が長くなっても結果を使うので、終わるまで出し直さない
+        if entry is None or (self.cache is None and now - entry[1] > self.budget):
+            token = object()
+            self._ensure_started()
+            try:
+                self._queue.put_nowait((token, key, percentage, status))
+            except queue.Full:
+                print(f"⚠️ Gemini生成待ちが上限({self._queue.maxsize}件)のため依頼を見送り: {key}")
+                return False
+            self._in_flight[key] = (token, now)
+            return True
+        return False
+    
+    def request(self, percentage, status):
+        """最新のセリフを返し、必要なら裏で新しいセリフの生成を依頼"""
+        if self.cache is not None:
+            message, stale = self.cache.pick(status, percentage)
+            MESSAGE_CACHE_LOOKUPS.inc(result='miss' if message is None else 'stale' if stale else 'hit')
+            if stale:
+                with self._lock:
+                    self._submit(self.cache.key(status, percentage), percentage, status)
+            return message or get_default_message(status, percentage)
+        
+        with self._lock:
+            self._submit(status, percentage, status)
+            message = self._latest.get(status)
+        
+        return message or get_default_message(status, percentage)
+    
+    def warm_up(self, percentages=range(101)):
+        """キャッシュにない・古くなった区間をまとめて生成依頼（以降はAPIを呼ばずに済む）"""
+        if self.cache is None:
+            return 0
+        queued = set()
+        with self._lock:
+            for percentage in percentages:
+                status = character_state(percentage)[0]
+                key = self.cache.key(status, percentage)
+                if key in queued:
+                    continue
+                if self.cache.needs_refresh(status, percentage) and self._submit(key, percentage, status):
+                    queued.add(key)
+        return len(queued)
+    
+    def _record_failure(self, key):
+        """失敗回数に応じて出し直しを待つ時間を延ばす（ロック取得済みで呼ぶ）"""
+        failures = self._failures.get(key, (0, 0))[0] + 1
+        backoff = min(GEMINI_RETRY_BACKOFF * 2 ** (failures - 1), GEMINI_RETRY_BACKOFF_MAX)
+        self._failures[key] = (failures, time.monotonic() + backoff)
+        print(f"⏳ セリフ生成に失敗したため {backoff:.0f}秒後まで出し直しを見送り: {key} ({failures}回連続)")
+    
+    def _run(self):
+        while True:
+            token, key, percentage, status = self._queue.get()
+            with self._lock:
+                entry = self._in_flight.get(key)
+                if entry is None or entry[0] is not token:
+                    continue  # 待っている間に置き換えられた依頼はAPIを呼ばずに捨てる
+            try:
+                if self.cache is not None:
+                    low, high = self.cache.bucket_range(self.cache.bucket(percentage))
+                    result = request_gemini_messages(low, high, status, timeout=self.budget)
+                else:
+                    result = request_gemini_message(percentage, status, timeout=self.budget)
+            except Exception as e:
+                print(f"Gemini API エラー: {e}")
+                result = None
+            
+            with self._lock:
+                entry = self._in_flight.get(key)
+                current = entry is not None and entry[0] is token
+                if current:
+                    del self._in_flight[key]
+                if result:
+                    self._failures.pop(key, None)
+                else:
+                    self._record_failure(key)
+                if self.cache is not None:
+                    # キャッシュは次回以降に使うので、遅れて届いた結果も保存する
+                    if result:
+                        self.cache.store(status, percentage, result)
+                        print(f"🗃️ セリフキャッシュ更新: {key} ({len(result)}件)")
+                    continue
+                if not current:
+                    continue  # 期限切れで置き換えられた依頼
+                elapsed = time.monotonic() - entry[1]
+                if elapsed > self.budget:
+                    print(f"⏱️ Gemini応答が遅すぎるため破棄: {elapsed:.1f}秒 ({status})")
+                elif result:
+                    self._latest[status] = result
+
+message_cache = MessageCache(MESSAGE_CACHE_PATH, MESSAGE_CACHE_TTL, MESSAGE_CACHE_MAX_KEYS, MESSAGE_BUCKET_SIZE) if MESSAGE_CACHE_PATH else None
+message_worker = CharacterMessageWorker(cache=message_cache)
+
 def get_default_message(status, percentage):
     """デフォルトメッセージ（API失敗時用）"""
     import random
@@ -109,7 +382,7 @@ def get_default_message(status, percentage):
 
 def send_line_message(message):
     """LINE Messaging API経由でメッセージ送信"""
-    url = "https://api.line.me/v2/bot/message/broadcast"
+    url = f"{LINE_API_BASE}/v2/bot/message/broadcast"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"
@@ -125,86 +398,349 @@ def send_line_message(message):
     }
     
     try:
-        response = requests.post(url, headers=headers, json=data)
+        with EXTERNAL_DURATION.time(service='line'):
+            response = http_transport.post(url, headers=headers, json=data)
         if response.status_code == 200:
             print(f"LINE送信成功: {message}")
             return True
         else:
+            EXTERNAL_ERRORS.inc(service='line')
             print(f"LINE送信失敗: {response.status_code} - {response.text}")
             return False
     except Exception as e:
+        EXTERNAL_ERRORS.inc(service='line')
         print(f"LINE送信エラー: {e}")
         return False
 
-def get_water_status_message(raw_value, percentage):
+def get_water_status_message(raw_value, percentage, low_threshold=WATER_LOW_THRESHOLD, ok_threshold=WATER_OK_THRESHOLD):
     """水分レベルに応じたLINEメッセージを生成"""
     current_time = time.strftime("%H:%M")
     
-    if percentage <= 30:
+    if percentage <= low_threshold:
         return f"🔴 植物の水分不足 ({current_time})\n💧 水分レベル: {percentage}%\n⚠️ 水やりが必要です！"
-    elif percentage <= 60:
+    elif percentage <= ok_threshold:
         return f"🟡 植物の水分は適度 ({current_time})\n💧 水分レベル: {percentage}%\n✅ 良好な状態です"
     else:
         return f"🟢 植物の水分は十分 ({current_time})\n💧 水分レベル: {percentage}%\n🎉 完璧な状態です！"
 
-def update_current_data(raw_value, percentage):
-    """現在のデータを更新"""
-    global current_data
-    
+def character_state(percentage):
+    """水分レベルからキャラクターの状態と画像を決める"""
     # 水分レベルに応じたパターン分け
     if percentage == 0:
-        status = "unknown"
-        face = "yousei1"  # ❶デフォルト：開始時 0%
+        return "unknown", "yousei1"  # ❶デフォルト：開始時 0%
     elif 1 <= percentage <= 90:
-        status = "yellow"
-        face = "yousei2"  # ❷ちょっとだけ喜ぶ：1%~90%
+        return "yellow", "yousei2"  # ❷ちょっとだけ喜ぶ：1%~90%
     elif 90 < percentage <= 100:
-        status = "green"
-        face = "yousei4"  # ❸喜ぶ：90~100%
+        return "green", "yousei4"  # ❸喜ぶ：90~100%
     else:
-        status = "red"
-        face = "yousei5"  # ❹怒る：開始時以外の0%
+        return "red", "yousei5"  # ❹怒る：開始時以外の0%
+
+def update_current_data(raw_value, percentage, data=None, low_threshold=WATER_LOW_THRESHOLD, ok_threshold=WATER_OK_THRESHOLD):
+    """現在のデータを更新（dataを省略すると1台監視用のcurrent_dataを更新）"""
+    if data is None:
+        data = current_data
     
-    character_message = generate_character_message(percentage, status)
+    status, face = character_state(percentage)
     
-    current_data.update({
+    # 生成は裏で行い、ここでは手元のセリフを即座に使う
+    character_message = message_worker.request(percentage, status)
+    
+    data.update({
         'raw_value': raw_value,
         'percentage': percentage,
         'status': status,
         'last_update': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'message': get_water_status_message(raw_value, percentage),
+        'message': get_water_status_message(raw_value, percentage, low_threshold, ok_threshold),
         'character_message': character_message,
         'character_face': face
     })
     
-    print(f"📊 データ更新: {percentage}% ({status}) | キャラクター: {character_message} | 画像: {face}")
+    device_label = f"[{data['device_id']}] " if data.get('device_id') else ""
+    print(f"📊 {device_label}データ更新: {percentage}% ({status}) | キャラクター: {character_message} | 画像: {face}")
+
+def is_permanent_rejection(status_code):
+    """サーバーが内容を理由に拒否した（再送しても通らない）応答か"""
+    return 400 <= status_code < 500 and status_code not in (401, 408, 429)
 
 def send_data_to_cloud(data):
-    """クラウドAPIにデータを送信"""
+    """クラウドAPIにデータを送信（成功でTrue、一時的な失敗でFalse、サーバーに拒否されたらNone）"""
     try:
         headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {API_SECRET_KEY}'
         }
         
-        response = requests.post(
-            f"{CLOUD_API_URL}/api/update",
-            json=data,
-            headers=headers,
-            timeout=10
-        )
+        with EXTERNAL_DURATION.time(service='cloud'):
+            response = http_transport.post(
+                f"{CLOUD_API_URL}/api/update",
+                json=data,
+                headers=headers
+            )
         
         if response.status_code == 200:
             print("☁️ クラウド送信成功")
             return True
+        elif is_permanent_rejection(response.status_code):
+            EXTERNAL_ERRORS.inc(service='cloud')
+            print(f"☁️ クラウドに拒否されました: {response.status_code} - {response.text[:200]}")
+            return None
         else:
+            EXTERNAL_ERRORS.inc(service='cloud')
             print(f"☁️ クラウド送信失敗: {response.status_code}")
             return False
             
     except Exception as e:
+        EXTERNAL_ERRORS.inc(service='cloud')
         print(f"☁️ クラウド送信エラー: {e}")
         return False
 
+def send_batch_to_cloud(readings):
+    """まとめた読み取り値をクラウドAPIに一括送信（戻り値は send_data_to_cloud と同じ）"""
+    try:
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {API_SECRET_KEY}'
+        }
+        
+        with EXTERNAL_DURATION.time(service='cloud_batch'):
+            response = http_transport.post(
+                f"{CLOUD_API_URL}/api/update/batch",
+                json={'readings': readings},
+                headers=headers
+            )
+        
+        if response.status_code == 200:
+            print(f"☁️ クラウド一括送信成功: {len(readings)}件")
+            return True
+        elif is_permanent_rejection(response.status_code):
+            EXTERNAL_ERRORS.inc(service='cloud_batch')
+            print(f"☁️ クラウド一括送信を拒否されました: {response.status_code} - {response.text[:200]}")
+            return None
+        else:
+            EXTERNAL_ERRORS.inc(service='cloud_batch')
+            print(f"☁️ クラウド一括送信失敗: {response.status_code}")
+            return False
+            
+    except Exception as e:
+        EXTERNAL_ERRORS.inc(service='cloud_batch')
+        print(f"☁️ クラウド一括送信エラー: {e}")
+        return False
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_outbox():
+    """未送信データキューを初回だけ開いて返す"""
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = SensorOutbox(OUTBOX_PATH, OUTBOX_MAX_ROWS, OUTBOX_MAX_AGE_HOURS * 3600)
+    return _outbox
+
+metrics.gauge('aquasync_outbox_backlog', 'クラウド未送信データの件数').set_function(
+    lambda: _outbox.count() if _outbox is not None else 0)
+
+def replay_page(outbox, ids, readings):
+    """1回分を再送（一時的な失敗ならFalse）
+    
+    サーバーに拒否されたら半分ずつ送り直し、拒否された行だけを rejected テーブルに移す。
+    拒否された行で後ろのデータが止まらないようにするため。
+    """
+    result = send_batch_to_cloud(readings)
+    if result:
+        outbox.ack(ids)
+        return True
+    if result is not None:
+        return False
+    if len(ids) == 1:
+        outbox.reject(ids)
+        print(f"🚫 クラウドに拒否された未送信データを再送対象から外しました: {readings[0]}")
+        return True
+    half = len(ids) // 2
+    return (replay_page(outbox, ids[:half], readings[:half])
+            and replay_page(outbox, ids[half:], readings[half:]))
+
+def replay_outbox():
+    """保存済みの未送信データを古い順に一括再送（全件送れたらTrue）"""
+    outbox = get_outbox()
+    while True:
+        ids, readings = outbox.peek(OUTBOX_REPLAY_BATCH)
+        if not readings:
+            return True
+        started = time.monotonic()
+        if not replay_page(outbox, ids, readings):
+            print(f"💾 未送信データ {outbox.count()}件 を保持して次回再送します")
+            return False
+        
+        # 復帰直後にサーバーへ負荷をかけすぎないよう再送ペースを制限
+        wait = len(readings) / OUTBOX_REPLAY_RATE - (time.monotonic() - started)
+        if wait > 0:
+            time.sleep(wait)
+
+def deliver_to_cloud(readings, send):
+    """読み取り値をクラウドへ届け、送れなかった分は保存して後で再送"""
+    outbox = get_outbox()
+    if outbox.count():
+        # 順序を保つため未送信分の後ろに並べてまとめて送る
+        outbox.append(readings)
+        replay_outbox()
+        return
+    result = send()
+    if result is None:
+        # 拒否された行だけを外して残りを送るため、再送の仕組みに任せる
+        outbox.append(readings)
+        replay_outbox()
+    elif not result:
+        outbox.append(readings)
+        print(f"💾 未送信データを保存: {len(readings)}件")
+
+def deliver_snapshot(data):
+    deliver_to_cloud([data], lambda: send_data_to_cloud(data))
+
+def deliver_batch(readings):
+    deliver_to_cloud(readings, lambda: send_batch_to_cloud(readings))
+
+def save_snapshot(data):
+    """送信キューからあふれたスナップショットを未送信データとして保存"""
+    get_outbox().append([data])
+
+def save_batch(readings):
+    """送信キューからあふれたバッチを未送信データとして保存"""
+    get_outbox().append(readings)
+
+class OutboundDestination:
+    """送信先1つ分のキューとワーカースレッド
+    
+    overflow を指定した宛先は、キューが満杯で押し出したデータを捨てずに overflow に渡す。
+    """
+    
+    def __init__(self, name, handler, latest_only=False, maxsize=OUTBOUND_QUEUE_SIZE, overflow=None):
+        self.name = name
+        self.handler = handler
+        self.latest_only = latest_only
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0
+        self._pending = deque()
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread = None
+    
+    def put(self, payload, key=None):
+        """送信データを積む（待たずに戻る）"""
+        evicted = None
+        with self._cond:
+            if self.latest_only:
+                # 最新のスナップショットだけが意味を持つので同じキーの未送信分は捨てる
+                stale = [entry for entry in self._pending if entry[0] == key]
+                for entry in stale:
+                    self._pending.remove(entry)
+                self.dropped += len(stale)
+            if len(self._pending) >= self.maxsize:
+                _, evicted = self._pending.popleft()
+                if self.overflow is None:
+                    self.dropped += 1
+                    print(f"⚠️ 送信キューが満杯のため古いデータを破棄: {self.name}")
+            self._pending.append((key, payload))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'outbound-{self.name}', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        
+        if evicted is not None and self.overflow is not None:
+            # 送信ワーカーを止めないようロックの外で保存する
+            print(f"💾 送信キューが満杯のため古いデータを未送信データに保存: {self.name}")
+            try:
+                self.overflow(evicted)
+            except Exception as e:
+                self.dropped += 1
+                print(f"未送信データ保存エラー ({self.name}): {e}")
+    
+    def wait_idle(self, timeout):
+        """未送信データがなくなるまで最大timeout秒待つ"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                _, payload = self._pending.popleft()
+                self._busy = True
+            try:
+                self.handler(payload)
+            except Exception as e:
+                print(f"送信ワーカーエラー ({self.name}): {e}")
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+class OutboundDispatcher:
+    """クラウド・LINEへの送信を宛先ごとのワーカーに振り分ける
+    
+    宛先ごとに送信順序を保ち、読み取りループはキューに積むだけでネットワークを待たない。
+    """
+    
+    def __init__(self):
+        self.destinations = {}
+    
+    def register(self, name, handler, latest_only=False, maxsize=OUTBOUND_QUEUE_SIZE, overflow=None):
+        self.destinations[name] = OutboundDestination(name, handler, latest_only, maxsize, overflow)
+    
+    def submit(self, name, payload, key=None):
+        """送信データを積む（latest_onlyの宛先ではkeyごとに最新だけを残す）"""
+        self.destinations[name].put(payload, key)
+    
+    def wait_idle(self, timeout=5):
+        """終了時に未送信分をできるだけ送り切る"""
+        deadline = time.monotonic() + timeout
+        for destination in self.destinations.values():
+            destination.wait_idle(max(0, deadline - time.monotonic()))
+
+dispatcher = OutboundDispatcher()
+dispatcher.register('cloud', deliver_snapshot, latest_only=True, overflow=save_snapshot)
+dispatcher.register('line', send_line_message)
+dispatcher.register('cloud_batch', deliver_batch, overflow=save_batch)
+
+class CloudBatcher:
+    """読み取り値を蓄積し、件数か経過時間で一括送信する"""
+    
+    def __init__(self, max_size=CLOUD_BATCH_SIZE, max_age=CLOUD_BATCH_MAX_AGE):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._readings = []
+        self._first_added = None
+    
+    def add(self, reading):
+        """計測時刻付きの読み取り値を1件追加し、条件を満たせば送信"""
+        if not self._readings:
+            self._first_added = time.monotonic()
+        self._readings.append(reading)
+        self.poll()
+    
+    def poll(self):
+        """件数・経過時間の条件を確認して必要なら送信"""
+        if not self._readings:
+            return
+        if len(self._readings) >= self.max_size or time.monotonic() - self._first_added >= self.max_age:
+            self.flush()
+    
+    def flush(self):
+        """蓄積分をすぐに送信キューへ渡す"""
+        if self._readings:
+            dispatcher.submit('cloud_batch', self._readings)
+            self._readings = []
+            self._first_added = None
+
 def test_line_connection():
     """LINE接続テスト"""
     print("LINE Messaging API接続テスト中...")
@@ -213,46 +749,523 @@ def test_line_connection():
         print("✅ LINE接続成功")
     else:
         print("❌ LINE接続失敗")
+        print("LINE接続に問題があります。続行しますが通知は送信されません。")
+    return success
+
+def test_cloud_connection(data):
+    """クラウド接続テスト"""
+    print("☁️ クラウド接続テスト中...")
+    success = send_data_to_cloud(data)
+    if success:
+        print("✅ クラウド接続成功")
+    else:
+        print("❌ クラウド接続失敗")
     return success
 
+class StartupTimer:
+    """起動処理ごとの所要時間（別スレッドの処理も含む）"""
+    
+    def __init__(self, started=_STARTED):
+        self.started = started
+        self.steps = [('読み込み・設定', time.perf_counter() - started)]
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def step(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.steps.append((name, time.perf_counter() - started))
+    
+    def report(self):
+        """監視を始められるまでの時間と内訳を表示（終わっていない処理は表示しない）"""
+        with self._lock:
+            steps = ' / '.join(f"{name} {seconds:.2f}秒" for name, seconds in self.steps)
+        print(f"⏱️ 起動時間: {time.perf_counter() - self.started:.2f}秒 ({steps})")
+
+def start_connectivity_probes(data, timer):
+    """LINE・クラウドの接続テストを裏で始める（シリアル接続・Arduino起動待ちと同時に進める）"""
+    def probe(name, check, *args):
+        started = time.perf_counter()
+        with timer.step(name):
+            check(*args)
+        print(f"⏱️ {name}: {time.perf_counter() - started:.2f}秒（起動と並行）")
+    
+    threads = [
+        threading.Thread(target=probe, args=('LINE接続テスト', test_line_connection), name='probe-line', daemon=True),
+        threading.Thread(target=probe, args=('クラウド接続テスト', test_cloud_connection, dict(data)), name='probe-cloud', daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+# Arduinoの出力形式
+# 通常形式: "Raw: 512 -> 50% | 状態: ..."
+# 簡易形式: "R,512,50"（AquaSync.ino の COMPACT_SERIAL を有効にした場合）
+_VERBOSE_FRAME = re.compile(rb'Raw:[ \t]*(\d+)[ \t]*->[ \t]*(\d+)%')
+_COMPACT_FRAME = re.compile(rb'R,(\d+),(\d+)[ \t\r]*$')
+_FRAME_MARKER = ord('R')
+_STARTUP_BANNER = b'=== AquaSync'  # リセット後に setup() が出力する行
+_COMPACT_SEPARATOR = ord(',')
+
+def parse_arduino_frame(line):
+    """受信した1行（bytes）から (raw_value, percentage) を取り出す
+    
+    デコードせずにバイト列のまま解析する。どちらの形式も先頭が 'R' なので、
+    バナーやテスト出力などのデータ行以外は先頭1バイトの比較だけで除外できる。
+    """
+    if not line or line[0] != _FRAME_MARKER:
+        return None, None
+    
+    if len(line) > 1 and line[1] == _COMPACT_SEPARATOR:
+        match = _COMPACT_FRAME.match(line)
+    else:
+        match = _VERBOSE_FRAME.match(line)
+    if match is None:
+        return None, None
+    
+    raw_value, percentage = match.groups()
+    return int(raw_value), int(percentage)
+
 def parse_arduino_data(line):
-    """Arduinoからのデータを解析"""
-    try:
-        if "Raw:" in line and "%" in line:
-            parts = line.split("->")
-            if len(parts) >= 2:
-                raw_part = parts[0].split("Raw:")[-1].strip()
-                percent_part = parts[1].split("%")[0].strip()
-                
-                raw_value = int(raw_part)
-                percentage = int(percent_part)
-                
-                return raw_value, percentage
-    except Exception as e:
-        print(f"データ解析エラー: {e}")
+    """Arduinoからのデータ（文字列）を解析"""
+    return parse_arduino_frame(line.strip().encode())
+
+class SerialLineReader:
+    """受信済みのバイトをまとめて読み込み、行単位に分割するリーダー
+    
+    pyserialのreadline()は1バイトずつ読むため、in_waitingをまとめて
+    使い回しのバッファに読み込んでから改行でまとめて分割する。
+    """
+    
+    def __init__(self, port, chunk_size=SERIAL_CHUNK_SIZE, max_line=SERIAL_MAX_LINE):
+        self.port = port
+        self.chunk_size = chunk_size
+        self.max_line = max_line
+        self._buffer = bytearray()
+        
+        # 受信統計
+        self.total_bytes = 0
+        self.total_lines = 0
+        self.dropped_bytes = 0
+        self._window_started = time.monotonic()
+        self._window_bytes = 0
+        self._window_lines = 0
+    
+    def read_lines(self):
+        """読み取れる分をまとめて読み、完結した行（bytes）のリストを返す
+        
+        受信データがなければポートのタイムアウトまで待って空リストを返す。
+        """
+        waiting = self.port.in_waiting
+        chunk = self.port.read(min(waiting, self.chunk_size) if waiting else 1)
+        if not chunk:
+            return []
+        buffer = self._buffer
+        buffer += chunk
+        nbytes = len(chunk)
+        
+        # 1バイト目を待っている間に届いた残りもまとめて取り込む
+        waiting = self.port.in_waiting
+        if waiting:
+            rest = self.port.read(min(waiting, self.chunk_size))
+            buffer += rest
+            nbytes += len(rest)
+        
+        end = buffer.rfind(b'\n')
+        if end < 0:
+            if len(buffer) > self.max_line:
+                # 改行が来ないまま溜まり続けるデータはノイズとして捨てる
+                self.dropped_bytes += len(buffer)
+                del buffer[:]
+            self._count(nbytes, 0)
+            return []
+        
+        lines = [line.rstrip(b'\r') for line in buffer[:end].split(b'\n')]
+        del buffer[:end + 1]
+        lines = [line for line in lines if line]
+        self._count(nbytes, len(lines))
+        return lines
+    
+    def _count(self, nbytes, nlines):
+        self.total_bytes += nbytes
+        self.total_lines += nlines
+        self._window_bytes += nbytes
+        self._window_lines += nlines
+    
+    def take_rates(self):
+        """前回呼び出しからの (bytes/sec, lines/sec) を返して計測区間をリセット"""
+        now = time.monotonic()
+        elapsed = max(now - self._window_started, 1e-9)
+        rates = (self._window_bytes / elapsed, self._window_lines / elapsed)
+        self._window_started = now
+        self._window_bytes = 0
+        self._window_lines = 0
+        return rates
+
+class StatusTracker:
+    """しきい値付近のばたつきを抑えて通知用の状態を決める
+    
+    状態を上げるにはしきい値を hysteresis % 上回り、下げるには hysteresis % 下回る
+    必要がある。また状態が変わってから min_dwell 秒間は次の変化を受け付けない。
+    """
+    
+    RANK = {'red': 0, 'yellow': 1, 'green': 2}
+    
+    def __init__(self, classify, hysteresis=STATUS_HYSTERESIS, min_dwell=STATUS_MIN_DWELL):
+        self.classify = classify
+        self.hysteresis = hysteresis
+        self.min_dwell = min_dwell
+        self.status = None
+        self.changed_at = None
+        self.blocked = False  # 最短滞在時間で変化を見送っているか
+    
+    def due(self, now):
+        """見送った変化を今なら反映できるならTrue（次の読み取り値を間引かずに渡す）"""
+        return self.blocked and now - self.changed_at >= self.min_dwell
+    
+    def update(self, percentage, now):
+        """読み取り値を反映し、状態が変わった場合は (前の状態, 新しい状態) を返す"""
+        if self.status is None:
+            self.status = self.classify(percentage)
+            self.changed_at = now
+            return None
+        
+        # 不感帯の外まで動いたときだけ候補にする
+        self.blocked = False
+        rank = self.RANK[self.status]
+        upper = self.classify(percentage - self.hysteresis)
+        lower = self.classify(percentage + self.hysteresis)
+        if self.RANK[upper] > rank:
+            candidate = upper
+        elif self.RANK[lower] < rank:
+            candidate = lower
+        else:
+            return None
+        
+        if now - self.changed_at < self.min_dwell:
+            self.blocked = True
+            return None
+        
+        previous = self.status
+        self.status = candidate
+        self.changed_at = now
+        return previous, candidate
+
+class ReadingFilter:
+    """読み取り値を平滑化し、意味のある変化があったときだけ後段に流す
     
-    return None, None
+    ADCのノイズを ewma（指数移動平均）か median（直近 window 件の中央値）でならし、
+    前回流した値から deadband % 以上動いたとき、または heartbeat 秒経ったときだけ値を返す。
+    """
+    
+    def __init__(self, mode=READING_FILTER, alpha=READING_EWMA_ALPHA, window=READING_MEDIAN_WINDOW,
+                 deadband=READING_DEADBAND, heartbeat=READING_HEARTBEAT):
+        if mode not in ('ewma', 'median', 'none'):
+            raise ValueError(f"Unknown READING_FILTER: {mode}")
+        self.mode = mode
+        self.alpha = min(1.0, max(0.0, alpha))
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+        self._average = None  # ewma: (raw_value, percentage)
+        self._window = deque(maxlen=max(1, window))
+        self.last_forwarded = None
+        self.last_forward_time = None
+        self.suppressed = 0
+    
+    def smooth(self, raw_value, percentage):
+        """平滑化した (raw_value, percentage) を整数で返す"""
+        if self.mode == 'ewma':
+            if self._average is None:
+                self._average = (raw_value, percentage)
+            else:
+                raw_average, pct_average = self._average
+                self._average = (raw_average + self.alpha * (raw_value - raw_average),
+                                 pct_average + self.alpha * (percentage - pct_average))
+            return round(self._average[0]), round(self._average[1])
+        if self.mode == 'median':
+            self._window.append((raw_value, percentage))
+            return median_low(raw for raw, _ in self._window), median_low(pct for _, pct in self._window)
+        return raw_value, percentage
+    
+    def update(self, raw_value, percentage, now, force=False):
+        """後段に流す値を返す（変化が小さく heartbeat 前ならNone、force なら必ず流す）"""
+        raw_value, percentage = self.smooth(raw_value, percentage)
+        if (not force and self.last_forwarded is not None
+                and abs(percentage - self.last_forwarded[1]) < self.deadband
+                and now - self.last_forward_time < self.heartbeat):
+            self.suppressed += 1
+            return None
+        self.last_forwarded = (raw_value, percentage)
+        self.last_forward_time = now
+        return raw_value, percentage
+
+class SensorDevice:
+    """Arduino1台分の監視状態（データ・しきい値・通知状態）"""
+    
+    def __init__(self, device_id, port, low_threshold=WATER_LOW_THRESHOLD, ok_threshold=WATER_OK_THRESHOLD, data=None):
+        self.device_id = device_id
+        self.port = port
+        self.low_threshold = low_threshold
+        self.ok_threshold = ok_threshold
+        self.data = data if data is not None else dict(current_data)
+        if device_id:
+            self.data['device_id'] = device_id
+        self.label = f"[{device_id}] " if device_id else ""
+        self.metric_label = device_id or 'default'
+        self.serial = None
+        self.reader = None
+        self.batcher = CloudBatcher()
+        self.reading_filter = ReadingFilter()
+        
+        # 状態追跡変数
+        self.status_tracker = StatusTracker(self.classify)
+        self.pending_changes = []  # 通知待ちの状態変化 (時刻, 前の状態, 新しい状態)
+        self.last_reading = None
+        self.last_notify_time = 0
+        self.last_report_time = time.time()
+        self.last_cloud_update = time.time()
+        self.last_stats_time = time.monotonic()
+    
+    def open(self, timeout):
+        """シリアルポートを開いて行リーダーを準備"""
+        self.serial = serial.Serial(self.port, SERIAL_BAUDRATE, timeout=timeout)
+        self.reader = SerialLineReader(self.serial)
+    
+    def _read_lines(self):
+        received = self.reader.total_bytes
+        lines = self.reader.read_lines()
+        SERIAL_BYTES.inc(self.reader.total_bytes - received, device=self.metric_label)
+        if lines:
+            SERIAL_LINES.inc(len(lines), device=self.metric_label)
+        return lines
+    
+    def read_available(self):
+        """受信済みの行をまとめて処理"""
+        for line in self._read_lines():
+            self.handle_line(line)
+    
+    def wait_ready(self, deadline):
+        """Arduinoの起動バナー（またはデータ行）が届くまで待つ
+        
+        ポートを開くとArduinoはリセットされるので、それ以前の途中の行は捨てる。
+        リセットされない基板ではデータ行が届いた時点で準備完了とみなす。
+        """
+        while time.monotonic() < deadline:
+            lines = self._read_lines()
+            for index, line in enumerate(lines):
+                if line.startswith(_STARTUP_BANNER) or parse_arduino_frame(line)[0] is not None:
+                    for rest in lines[index:]:
+                        self.handle_line(rest)
+                    return True
+            if not lines:
+                time.sleep(0.01)  # timeout=0 で開いたポートを空回りさせない
+        return False
+    
+    def classify(self, percentage):
+        """しきい値から通知用の状態を判定"""
+        if percentage <= self.low_threshold:
+            return "red"
+        elif percentage <= self.ok_threshold:
+            return "yellow"
+        else:
+            return "green"
+    
+    def snapshot(self):
+        """送信用に計測時刻付きでデータを複製"""
+        data = dict(self.data)
+        data['timestamp'] = time.time()
+        return data
+    
+    def status_message(self, raw_value, percentage):
+        return self.label + get_water_status_message(raw_value, percentage, self.low_threshold, self.ok_threshold)
+    
+    def handle_line(self, line):
+        """Arduinoから受信した1行（bytes）を処理"""
+        if SERIAL_ECHO:
+            print(f"{self.label}受信: {line.decode(errors='replace')}")
+        
+        # 水分データの解析（デコード不要のバイト列パーサー）
+        raw_value, percentage = parse_arduino_frame(line)
+        if raw_value is not None and percentage is not None:
+            READINGS.inc(device=self.metric_label)
+            # 平滑化して、ほとんど動いていない値は後段の処理（更新・状態判定・送信）を省く。
+            # ただし最短滞在時間で見送った状態変化は、時間が過ぎたら次の値で判定し直す
+            force = self.status_tracker.due(time.time())
+            reading = self.reading_filter.update(raw_value, percentage, time.monotonic(), force=force)
+            if reading is None:
+                READINGS_SUPPRESSED.inc(device=self.metric_label)
+            else:
+                self.handle_reading(*reading)
+        elif line[:1] == b'R':
+            # データ行の先頭なのに形式が合わない（バナー等の他の行は数えない）
+            PARSE_FAILURES.inc(device=self.metric_label)
+    
+    def handle_reading(self, raw_value, percentage):
+        """解析済みの読み取り値を処理"""
+        current_time = time.time()
+        self.last_reading = (raw_value, percentage)
+        
+        # データを常時更新
+        update_current_data(raw_value, percentage, self.data, self.low_threshold, self.ok_threshold)
+        if CLOUD_BATCH_MODE:
+            self.batcher.add(self.snapshot())
+        
+        # 状態変化の検出（ヒステリシスと最短滞在時間でばたつきを抑える）
+        change = self.status_tracker.update(percentage, current_time)
+        if change is not None:
+            previous, current_status = change
+            print(f"🔔 {self.label}状態変化検出: {previous} → {current_status}")
+            self.send_status_report(raw_value, percentage, previous, current_status)
+        
+        # 定期的にクラウドに送信（バッチモードでは件数・経過時間で送信）
+        if not CLOUD_BATCH_MODE and current_time - self.last_cloud_update >= CLOUD_UPDATE_INTERVAL:
+            dispatcher.submit('cloud', self.snapshot(), key=self.device_id)
+            self.last_cloud_update = current_time
+        
+        # 定期レポート
+        if current_time - self.last_report_time >= REPORT_INTERVAL:
+            print(f"📊 {self.label}定期レポート送信中...")
+            message = f"📊 定期レポート\n{self.status_message(raw_value, percentage)}\n\n次回レポート: {REPORT_INTERVAL // 60}分後"
+            dispatcher.submit('line', message)
+            self.last_report_time = current_time
+    
+    def poll(self):
+        """読み取りがなくても行う時間経過の処理"""
+        if CLOUD_BATCH_MODE:
+            self.batcher.poll()
+        
+        # まとめ待ちの状態変化通知
+        if self.pending_changes and time.time() - self.last_notify_time >= NOTIFY_DIGEST_WINDOW:
+            self.flush_notifications()
+        
+        # シリアル受信レートの定期表示（ボーレート・サンプリング間隔の調整用）
+        if SERIAL_STATS_INTERVAL and self.reader is not None:
+            now = time.monotonic()
+            if now - self.last_stats_time >= SERIAL_STATS_INTERVAL:
+                bytes_per_sec, lines_per_sec = self.reader.take_rates()
+                SERIAL_LINE_RATE.set(lines_per_sec, device=self.metric_label)
+                print(f"📶 {self.label}シリアル受信: {bytes_per_sec:.1f} bytes/s, {lines_per_sec:.2f} lines/s "
+                      f"(累計 {self.reader.total_bytes} bytes / {self.reader.total_lines} 行)")
+                self.last_stats_time = now
+    
+    def send_status_report(self, raw_value, percentage, previous, status_type):
+        """状態変化をクラウドに反映し、LINE通知をまとめて送信"""
+        # クラウドへの送信はワーカーに任せる
+        if CLOUD_BATCH_MODE:
+            self.batcher.flush()
+        else:
+            dispatcher.submit('cloud', self.snapshot(), key=self.device_id)
+        
+        # 前回の通知からまとめ時間内の変化は次のまとめ通知に回す
+        self.pending_changes.append((time.strftime("%H:%M"), previous, status_type))
+        if time.time() - self.last_notify_time >= NOTIFY_DIGEST_WINDOW:
+            self.flush_notifications()
+        else:
+            print(f"🗂️ {self.label}状態変化通知をまとめ待ちに追加 ({len(self.pending_changes)}件)")
+    
+    def flush_notifications(self):
+        """まとめ待ちの状態変化を1通のLINE通知にして送信"""
+        if not self.pending_changes or self.last_reading is None:
+            return
+        message = self.status_message(*self.last_reading)
+        if len(self.pending_changes) > 1:
+            history = "\n".join(f"{at} {previous} → {status}" for at, previous, status in self.pending_changes)
+            message = f"🔔 状態変化まとめ ({len(self.pending_changes)}件)\n{history}\n\n{message}"
+        dispatcher.submit('line', message)
+        print("📨 状態変化通知を送信キューに追加")
+        self.pending_changes = []
+        self.last_notify_time = time.time()
+    
+    def close(self):
+        self.flush_notifications()
+        self.batcher.flush()
+        if self.serial is not None:
+            self.serial.close()
 
-def send_status_report(raw_value, percentage, status_type):
-    """状態に応じたLINE通知を送信"""
-    message = get_water_status_message(raw_value, percentage)
+def load_devices():
+    """環境変数から監視するArduinoの一覧を作成"""
+    thresholds = {}
+    for entry in filter(None, (item.strip() for item in DEVICE_THRESHOLDS.split(','))):
+        device_id, _, values = entry.partition('=')
+        low, _, ok = values.partition(':')
+        thresholds[device_id.strip()] = (int(low), int(ok))
     
-    # データ更新
-    update_current_data(raw_value, percentage)
+    if not ARDUINO_PORTS:
+        low, ok = thresholds.get(DEVICE_ID, (WATER_LOW_THRESHOLD, WATER_OK_THRESHOLD))
+        return [SensorDevice(DEVICE_ID, ARDUINO_PORT, low, ok, data=current_data)]
+    
+    devices = []
+    for index, entry in enumerate(filter(None, (item.strip() for item in ARDUINO_PORTS.split(',')))):
+        device_id, sep, port = entry.partition('=')
+        if not sep:
+            device_id, port = f"sensor{index + 1}", device_id
+        device_id = device_id.strip()
+        low, ok = thresholds.get(device_id, (WATER_LOW_THRESHOLD, WATER_OK_THRESHOLD))
+        devices.append(SensorDevice(device_id, port.strip(), low, ok))
+    return devices
+
+def wait_devices_ready(devices, timer):
+    """全台の起動バナーを待つ（同時に開いたので待ち時間は最も遅い1台分）"""
+    with timer.step('Arduino起動待ち'):
+        deadline = time.monotonic() + ARDUINO_READY_TIMEOUT
+        for device in devices:
+            if not device.wait_ready(deadline):
+                print(f"⚠️ {device.label}起動メッセージが{ARDUINO_READY_TIMEOUT:.0f}秒以内に届きませんでした。そのまま監視を始めます")
+    timer.report()
+
+def run_single_device(device, timer):
+    """Arduino1台を監視"""
+    with timer.step('シリアル接続'):
+        device.open(timeout=SERIAL_READ_TIMEOUT)
+    wait_devices_ready([device], timer)
+    print("Arduino接続成功！水分監視を開始します。")
     
-    # クラウドに送信
-    send_data_to_cloud(current_data)
+    while True:
+        try:
+            # タイムアウト付きで読むので受信がなくても時間経過の処理を行える
+            device.read_available()
+            device.poll()
+        except Exception as e:
+            print(f"読み取りエラー: {e}")
+            time.sleep(1)
+
+def run_multi_device(devices, timer):
+    """複数のArduinoを1プロセスで多重化して監視"""
+    with timer.step('シリアル接続'):
+        for device in devices:
+            device.open(timeout=0)
+            print(f"🔌 {device.label}接続: {device.port} (しきい値 {device.low_threshold}%/{device.ok_threshold}%)")
+    wait_devices_ready(devices, timer)
+    print(f"Arduino {len(devices)}台 接続成功！水分監視を開始します。")
     
-    if status_type == "green":
-        success = send_line_message(message)
+    # POSIXではselectorsで読み取り可能なポートだけを待つ（Windowsは短い間隔で巡回）
+    if os.name != 'nt':
+        selector = selectors.DefaultSelector()
+        for device in devices:
+            selector.register(device.serial.fileno(), selectors.EVENT_READ, device)
+        wait_readable = lambda: [key.data for key, _ in selector.select(timeout=SERIAL_READ_TIMEOUT)]
     else:
-        success = send_line_message(message)
+        def wait_readable():
+            time.sleep(0.05)
+            return [device for device in devices if device.serial.in_waiting]
     
-    return success
+    while True:
+        for device in wait_readable():
+            try:
+                device.read_available()
+            except Exception as e:
+                print(f"{device.label}読み取りエラー: {e}")
+        
+        for device in devices:
+            device.poll()
 
 def main():
     print(f"🌱 AquaSync ローカルセンサーシステム 🌱")
-    print(f"Arduino監視開始: {ARDUINO_PORT}")
+    devices = load_devices()
+    print(f"Arduino監視開始: {', '.join(device.label + str(device.port) for device in devices)}")
     print(f"Channel Access Token設定: {'OK' if CHANNEL_ACCESS_TOKEN else 'NG'}")
     print(f"Gemini API Key設定: {'OK' if GEMINI_API_KEY else 'NG'}")
     print(f"クラウドAPI URL: {CLOUD_API_URL}")
@@ -260,102 +1273,54 @@ def main():
     if not CHANNEL_ACCESS_TOKEN:
         print("❌ CHANNEL_ACCESS_TOKENが設定されていません")
         return
+    
+    if METRICS_PORT:
+        try:
+            metrics.start_http_server(METRICS_PORT, METRICS_HOST)
+            print(f"📈 メトリクス: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            print(f"⚠️ メトリクスサーバーを起動できません: {e}")
 
-    # 初期キャラクターメッセージ設定
-    initial_message = generate_character_message(0, 'unknown')
-    current_data['character_message'] = initial_message
-    print(f"🎭 キャラクター初期化: {initial_message}")
+    timer = StartupTimer()
     
-    # LINE接続テスト
-    if not test_line_connection():
-        print("LINE接続に問題があります。続行しますが通知は送信されません。")
+    # セリフキャッシュの足りない区間を裏でまとめて生成
+    queued = message_worker.warm_up()
+    if message_cache is not None:
+        print(f"🗃️ セリフキャッシュ: {len(message_cache)}区間 保存済み / {queued}区間 を生成依頼")
     
-    # クラウド接続テスト
-    print("☁️ クラウド接続テスト中...")
-    if send_data_to_cloud(current_data):
-        print("✅ クラウド接続成功")
-    else:
-        print("❌ クラウド接続失敗")
+    # 初期キャラクターメッセージ設定（Geminiの応答は待たず、手元のセリフを使う）
+    initial_message = message_worker.request(0, 'unknown')
+    for device in devices:
+        device.data['character_message'] = initial_message
+    print(f"🎭 キャラクター初期化: {initial_message}")
+    
+    # LINE・クラウドの接続テストはシリアル接続と並行して行う
+    start_connectivity_probes(devices[0].data, timer)
     
     print("✅ システム準備完了")
     print("📊 水分レベル変化と定期レポートでLINE通知を送信します")
     print("☁️ データをクラウドに送信してWebダッシュボードに反映します")
-    
-    # 状態追跡変数
-    last_status = None
-    last_report_time = time.time()
-    last_cloud_update = time.time()
-    report_interval = 600  # 10分間隔での定期レポート
-    cloud_update_interval = 10  # 10秒間隔でクラウド更新
+    if CLOUD_BATCH_MODE:
+        print(f"📦 バッチ送信モード: {CLOUD_BATCH_SIZE}件または{CLOUD_BATCH_MAX_AGE:.0f}秒ごとに一括送信")
+    backlog = get_outbox().count()
+    if backlog:
+        print(f"💾 未送信データ {backlog}件 はクラウド復帰後に再送します")
     
     try:
-        arduino = serial.Serial(ARDUINO_PORT, 9600)
-        time.sleep(2)
-        print("Arduino接続成功！水分監視を開始します。")
-        
-        while True:
-            try:
-                line = arduino.readline().decode().strip()
-                if line:
-                    print(f"受信: {line}")
-                    
-                    # 水分データの解析
-                    raw_value, percentage = parse_arduino_data(line)
-                    if raw_value is not None and percentage is not None:
-                        current_time = time.time()
-                        
-                        # 状態変化の検出
-                        current_status = None
-                        if percentage <= 30:
-                            current_status = "red"
-                        elif percentage <= 60:
-                            current_status = "yellow"
-                        else:
-                            current_status = "green"
-                        
-                        # データを常時更新
-                        update_current_data(raw_value, percentage)
-                        
-                        # 状態が変わった場合に通知
-                        if current_status != last_status and last_status is not None:
-                            print(f"🔔 状態変化検出: {last_status} → {current_status}")
-                            success = send_status_report(raw_value, percentage, current_status)
-                            if success:
-                                print("✅ 状態変化通知送信完了")
-                            else:
-                                print("❌ 状態変化通知送信失敗")
-                        
-                        last_status = current_status
-                        
-                        # 定期的にクラウドに送信（15秒間隔）
-                        if current_time - last_cloud_update >= cloud_update_interval:
-                            send_data_to_cloud(current_data)
-                            last_cloud_update = current_time
-                        
-                        # 定期レポート（5分間隔）
-                        if current_time - last_report_time >= report_interval:
-                            print("📊 定期レポート送信中...")
-                            message = f"📊 定期レポート\n{get_water_status_message(raw_value, percentage)}\n\n次回レポート: 5分後"
-                            success = send_line_message(message)
-                            if success:
-                                print("✅ 定期レポート送信完了")
-                                last_report_time = current_time
-                            else:
-                                print("❌ 定期レポート送信失敗")
-                    
-            except KeyboardInterrupt:
-                print("\n監視を終了します")
-                break
-            except UnicodeDecodeError as e:
-                print(f"文字エンコードエラー: {e}")
-                time.sleep(0.1)
-            except Exception as e:
-                print(f"読み取りエラー: {e}")
-                time.sleep(1)
-                
+        if len(devices) > 1:
+            run_multi_device(devices, timer)
+        else:
+            run_single_device(devices[0], timer)
+    except KeyboardInterrupt:
+        print("\n監視を終了します")
     except Exception as e:
         print(f"Arduino接続エラー: {e}")
         print("ポート名やArduino IDEのシリアルモニタが開いていないか確認してください。")
+    finally:
+        for device in devices:
+            device.close()
+        dispatcher.wait_idle()
+        print(f"🔌 接続統計:\n{http_transport.format_stats()}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
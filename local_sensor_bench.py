@@ -0,0 +1,402 @@
+"""AquaSync ローカルセンサー ベンチマーク
+
+記録したシリアル出力を使って local_sensor.py の処理性能を計測する。
+
+    python local_sensor_bench.py parser [--capture bench_data/serial_capture.log]
+    python local_sensor_bench.py replay [--speed 100] [--cloud-latency 0.2] [--error-rate 0.1]
+        [--cloud-error-rate 0.3] [--line-error-rate 0] [--gemini-error-rate 0.5]
+
+replay は実機やAPIの代わりに、キャプチャを再生する疑似シリアルと
+クラウド・LINE・Geminiの代替HTTPサーバーを使う。
+"""
+import argparse
+import contextlib
+import http.server
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+DEFAULT_CAPTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_data', 'serial_capture.log')
+
+def legacy_parse_arduino_data(line):
+    """比較用: 文字列ベースの旧パーサー"""
+    try:
+        if "Raw:" in line and "%" in line:
+            parts = line.split("->")
+            if len(parts) >= 2:
+                raw_part = parts[0].split("Raw:")[-1].strip()
+                percent_part = parts[1].split("%")[0].strip()
+
+                raw_value = int(raw_part)
+                percentage = int(percent_part)
+
+                return raw_value, percentage
+    except Exception as e:
+        print(f"データ解析エラー: {e}")
+
+    return None, None
+
+def load_capture(path):
+    """キャプチャファイルを改行で区切ったバイト列のリストとして読み込む"""
+    with open(path, 'rb') as f:
+        return [line.rstrip(b'\r') for line in f.read().split(b'\n') if line.strip()]
+
+def to_compact(lines):
+    """データ行を簡易形式 "R,<raw>,<pct>" に変換（それ以外の行はそのまま）"""
+    pattern = re.compile(rb'Raw:\s*(\d+)\s*->\s*(\d+)%')
+    converted = []
+    for line in lines:
+        match = pattern.match(line)
+        converted.append(b'R,%s,%s' % match.groups() if match else line)
+    return converted
+
+def time_per_line(func, lines, repeat=5, min_time=0.2):
+    """1行あたりの処理時間（ナノ秒、最良値）を計測"""
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func(lines)
+        if time.perf_counter() - started >= min_time:
+            break
+        loops *= 2
+
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func(lines)
+        best = min(best, time.perf_counter() - started)
+    return best / (loops * len(lines)) * 1e9
+
+def run_legacy(lines):
+    # 旧ループ相当: readline().decode().strip() の後に文字列で解析
+    parse = legacy_parse_arduino_data
+    for raw in lines:
+        parse(raw.decode().strip())
+
+def run_bytes(lines):
+    import local_sensor
+    parse = local_sensor.parse_arduino_frame
+    for raw in lines:
+        parse(raw)
+
+def bench_parser(args):
+    import local_sensor
+    lines = load_capture(args.capture)
+    compact = to_compact(lines)
+
+    # 新旧パーサーの結果が一致することを確認してから計測する
+    expected = [legacy_parse_arduino_data(line.decode().strip()) for line in lines]
+    assert [local_sensor.parse_arduino_frame(line) for line in lines] == expected
+    assert [local_sensor.parse_arduino_frame(line) for line in compact] == expected
+
+    data_lines = sum(1 for value in expected if value[0] is not None)
+    results = {
+        'capture': os.path.basename(args.capture),
+        'lines': len(lines),
+        'data_lines': data_lines,
+        'ns_per_line': {
+            'legacy_str': time_per_line(run_legacy, lines, args.repeat),
+            'bytes': time_per_line(run_bytes, lines, args.repeat),
+            'bytes_compact': time_per_line(run_bytes, compact, args.repeat),
+        },
+    }
+
+    legacy = results['ns_per_line']['legacy_str']
+    print(f"📄 キャプチャ: {results['capture']} ({len(lines)}行 / データ行 {data_lines})")
+    for name, ns in results['ns_per_line'].items():
+        print(f"  {name:<14} {ns:8.0f} ns/行  {1e9 / ns:12,.0f} 行/秒  x{legacy / ns:.2f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 結果を保存: {args.json}")
+    return results
+
+def percentile(values, pct):
+    """パーセンタイル値（最近傍法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def summarize(values):
+    """秒単位の計測値をミリ秒の p50/p99/max にまとめる"""
+    return {
+        'p50_ms': percentile(values, 50) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values, default=0.0) * 1000,
+    }
+
+class FakeSerial:
+    """キャプチャを実時間の speed 倍で再生する疑似シリアルポート
+
+    データ行は Arduino と同じく interval 秒ごとに届き、
+    バナーなどの行は次のデータ行と一緒に届く。
+    """
+
+    def __init__(self, lines, interval=3.0, speed=100.0, timeout=0.5):
+        self.timeout = timeout
+        self.schedule = []  # (到着時刻オフセット, バイト列)
+        self.data_arrivals = []  # データ行の到着時刻オフセット
+        offset = 0.0
+        for line in lines:
+            self.schedule.append((offset, bytes(line) + b'\r\n'))
+            if line.startswith(b'R'):
+                self.data_arrivals.append(offset)
+                offset += interval / speed
+        self.started = None
+        self._index = 0
+        self._buffer = bytearray()
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def _release(self):
+        now = time.perf_counter() - self.started
+        while self._index < len(self.schedule) and self.schedule[self._index][0] <= now:
+            self._buffer += self.schedule[self._index][1]
+            self._index += 1
+        return now
+
+    @property
+    def in_waiting(self):
+        self._release()
+        return len(self._buffer)
+
+    @property
+    def exhausted(self):
+        return self._index >= len(self.schedule) and not self._buffer
+
+    def read(self, size=1):
+        now = self._release()
+        if not self._buffer and self.timeout and self._index < len(self.schedule):
+            # 次の行が届くかタイムアウトするまで待つ
+            wait = min(self.timeout, self.schedule[self._index][0] - now)
+            if wait > 0:
+                time.sleep(wait)
+            self._release()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def close(self):
+        pass
+
+class MockServiceHandler(http.server.BaseHTTPRequestHandler):
+    """クラウド・LINE・Geminiの代替エンドポイント"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        service = self.server.route(self.path)
+        if service is None:
+            self._reply(404, {'error': 'not found'})
+            return
+
+        config = self.server.config[service]
+        time.sleep(config['latency'])
+        with self.server.lock:
+            stats = self.server.stats.setdefault(service, {'requests': 0, 'errors': 0, 'bytes': 0})
+            stats['requests'] += 1
+            stats['bytes'] += len(body)
+            failed = self.server.random.random() < config['error_rate']
+            if failed:
+                stats['errors'] += 1
+
+        if failed:
+            self._reply(503, {'error': 'injected failure'})
+        elif service == 'gemini':
+            self._reply(200, {'candidates': [{
+                'content': {'parts': [{'text': 'ベンチマーク中だよ！いつもありがとう'}], 'role': 'model'},
+                'finishReason': 'STOP',
+                'index': 0,
+            }]})
+        else:
+            self._reply(200, {'status': 'success'})
+
+    def _reply(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MockServices(http.server.ThreadingHTTPServer):
+    """遅延とエラー率を注入できる代替HTTPサーバー"""
+
+    daemon_threads = True
+
+    def __init__(self, config, seed=0):
+        super().__init__(('127.0.0.1', 0), MockServiceHandler)
+        self.config = config
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.url = f"http://127.0.0.1:{self.server_port}"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def route(path):
+        if path.startswith('/api/update'):
+            return 'cloud'
+        if path.startswith('/v2/bot/message/'):
+            return 'line'
+        if ':generateContent' in path:
+            return 'gemini'
+        return None
+
+def service_error_rate(rate, args):
+    """サービス別の指定がなければ --error-rate を使う"""
+    return args.error_rate if rate is None else rate
+
+def bench_replay(args):
+    services = MockServices({
+        'cloud': {'latency': args.cloud_latency, 'error_rate': service_error_rate(args.cloud_error_rate, args)},
+        'line': {'latency': args.line_latency, 'error_rate': service_error_rate(args.line_error_rate, args)},
+        'gemini': {'latency': args.gemini_latency, 'error_rate': service_error_rate(args.gemini_error_rate, args)},
+    }, seed=args.seed)
+    workdir = tempfile.mkdtemp(prefix='aquasync-bench-')
+
+    # local_sensor は読み込み時に設定を読むので、先に代替サービスへ向ける
+    os.environ.update({
+        'CLOUD_API_URL': services.url,
+        'LINE_API_BASE': services.url,
+        'GEMINI_API_ENDPOINT': services.url,
+        'GEMINI_API_KEY': 'bench',
+        'CHANNEL_ACCESS_TOKEN': 'bench',
+        'API_SECRET_KEY': 'bench',
+        'OUTBOX_PATH': os.path.join(workdir, 'outbox.db'),
+        'MESSAGE_CACHE_PATH': os.path.join(workdir, 'messages.json'),
+        'SERIAL_ECHO': '1' if args.echo else '0',
+        'CLOUD_UPDATE_INTERVAL': str(args.cloud_interval),
+        'REPORT_INTERVAL': str(args.report_interval),
+        # 時間で判定する設定は再生倍率に合わせて縮める
+        'STATUS_MIN_DWELL': str(args.min_dwell / args.speed),
+        'NOTIFY_DIGEST_WINDOW': str(args.digest_window / args.speed),
+        'READING_HEARTBEAT': str(args.heartbeat / args.speed),
+        'READING_FILTER': args.filter,
+        'READING_DEADBAND': str(args.deadband),
+    })
+    if args.batch:
+        os.environ['CLOUD_BATCH_MODE'] = '1'
+    import local_sensor
+
+    lines = load_capture(args.capture)
+    port = FakeSerial(lines, interval=args.interval, speed=args.speed, timeout=local_sensor.SERIAL_READ_TIMEOUT)
+    device = local_sensor.SensorDevice(None, 'bench', data=local_sensor.current_data)
+    device.serial = port
+    device.reader = local_sensor.SerialLineReader(port)
+
+    # データ行ごとの処理時間（平滑化で後段を省いた行も含む）と、到着から処理完了までの遅れ（ループラグ）を記録
+    processing, lag = [], []
+    handle_line = device.handle_line
+    def timed_handle_line(line):
+        started = time.perf_counter()
+        handle_line(line)
+        finished = time.perf_counter()
+        if not line.startswith(b'R') or len(lag) >= len(port.data_arrivals):
+            return
+        processing.append(finished - started)
+        arrival = port.data_arrivals[len(lag)]
+        lag.append(finished - port.started - arrival)
+    device.handle_line = timed_handle_line
+
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        port.start()
+        while not port.exhausted:
+            device.read_available()
+            device.poll()
+        loop_elapsed = time.perf_counter() - port.started
+        device.close()
+        drained = local_sensor.dispatcher.wait_idle(args.drain_timeout)
+
+    results = {
+        'capture': os.path.basename(args.capture),
+        'speed': args.speed,
+        'batch_mode': args.batch,
+        'readings': len(processing),
+        'filter': args.filter,
+        'suppressed': device.reading_filter.suppressed,
+        'loop_seconds': loop_elapsed,
+        'readings_per_sec': len(processing) / loop_elapsed if loop_elapsed else 0.0,
+        'processing': summarize(processing),
+        'loop_lag': summarize(lag),
+        'services': services.stats,
+        'dropped': {name: dest.dropped for name, dest in local_sensor.dispatcher.destinations.items()},
+        'outbox_backlog': local_sensor.get_outbox().count(),
+        'outbound_drained': drained,
+    }
+    services.shutdown()
+
+    print(f"📄 キャプチャ: {results['capture']} / {args.speed:g}倍速 / データ行 {results['readings']}"
+          f" (フィルター {args.filter}: 後段を省略 {results['suppressed']}件)")
+    print(f"⏱️ 処理時間  p50 {results['processing']['p50_ms']:.2f}ms  p99 {results['processing']['p99_ms']:.2f}ms  max {results['processing']['max_ms']:.2f}ms")
+    print(f"⏱️ ループ遅延 p50 {results['loop_lag']['p50_ms']:.2f}ms  p99 {results['loop_lag']['p99_ms']:.2f}ms  max {results['loop_lag']['max_ms']:.2f}ms")
+    for service, stats in sorted(results['services'].items()):
+        print(f"🌐 {service}: {stats['requests']}件 (エラー {stats['errors']}件, {stats['bytes']} bytes)")
+    print(f"🗑️ 破棄: {results['dropped']} / 💾 未送信: {results['outbox_backlog']}件")
+
+    if args.log:
+        with open(args.log, 'w') as f:
+            f.write(log.getvalue())
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"💾 結果を保存: {args.json}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='AquaSync ローカルセンサー ベンチマーク')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_cmd = subparsers.add_parser('parser', help='シリアル行パーサーの比較')
+    parser_cmd.add_argument('--capture', default=DEFAULT_CAPTURE, help='シリアル出力のキャプチャファイル')
+    parser_cmd.add_argument('--repeat', type=int, default=5)
+    parser_cmd.add_argument('--json', help='結果をJSONで保存するパス')
+    parser_cmd.set_defaults(func=bench_parser)
+
+    replay_cmd = subparsers.add_parser('replay', help='疑似シリアルと代替サービスでループ全体を計測')
+    replay_cmd.add_argument('--capture', default=DEFAULT_CAPTURE, help='シリアル出力のキャプチャファイル')
+    replay_cmd.add_argument('--speed', type=float, default=100.0, help='実時間に対する再生倍率')
+    replay_cmd.add_argument('--interval', type=float, default=3.0, help='Arduinoの送信間隔（秒）')
+    replay_cmd.add_argument('--cloud-latency', type=float, default=0.2)
+    replay_cmd.add_argument('--line-latency', type=float, default=0.3)
+    replay_cmd.add_argument('--gemini-latency', type=float, default=1.0)
+    replay_cmd.add_argument('--error-rate', type=float, default=0.0, help='各サービスが503を返す確率')
+    replay_cmd.add_argument('--cloud-error-rate', type=float, help='クラウドが503を返す確率（省略時は --error-rate）')
+    replay_cmd.add_argument('--line-error-rate', type=float, help='LINEが503を返す確率（省略時は --error-rate）')
+    replay_cmd.add_argument('--gemini-error-rate', type=float, help='Geminiが503を返す確率（省略時は --error-rate）')
+    replay_cmd.add_argument('--cloud-interval', type=int, default=0, help='クラウド更新間隔（秒、0で毎回）')
+    replay_cmd.add_argument('--report-interval', type=int, default=600)
+    replay_cmd.add_argument('--min-dwell', type=float, default=30.0, help='状態の最短滞在時間（実時間の秒）')
+    replay_cmd.add_argument('--digest-window', type=float, default=300.0, help='通知まとめ時間（実時間の秒）')
+    replay_cmd.add_argument('--filter', default='median', choices=('ewma', 'median', 'none'), help='読み取り値の平滑化')
+    replay_cmd.add_argument('--deadband', type=float, default=1.0, help='後段に流す最小の変化（%）')
+    replay_cmd.add_argument('--heartbeat', type=float, default=60.0, help='変化がなくても流す間隔（実時間の秒）')
+    replay_cmd.add_argument('--batch', action='store_true', help='バッチ送信モードで計測')
+    replay_cmd.add_argument('--echo', action='store_true', help='受信行の表示も含めて計測')
+    replay_cmd.add_argument('--drain-timeout', type=float, default=10.0)
+    replay_cmd.add_argument('--seed', type=int, default=0)
+    replay_cmd.add_argument('--log', help='local_sensor の出力を保存するパス')
+    replay_cmd.add_argument('--json', help='結果をJSONで保存するパス')
+    replay_cmd.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
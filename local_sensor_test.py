@@ -1,15 +1,18 @@
-import requests
 import os
 import time
 from dotenv import load_dotenv
 from datetime import datetime
 
+import http_transport
+
 load_dotenv()
 
 # 設定
 CLOUD_API_URL = os.getenv('CLOUD_API_URL', 'https://emotan.onrender.com')
 API_SECRET_KEY = os.getenv('API_SECRET_KEY', 'aquasync-secret-key-2024')
 
+http_transport.configure_host(CLOUD_API_URL, retries=2)
+
 def send_data_to_cloud(data):
     """クラウドAPIにデータを送信"""
     try:
@@ -18,11 +21,10 @@ def send_data_to_cloud(data):
             'Authorization': f'Bearer {API_SECRET_KEY}'
         }
         
-        response = requests.post(
+        response = http_transport.post(
             f"{CLOUD_API_URL}/api/update",
             json=data,
-            headers=headers,
-            timeout=10
+            headers=headers
         )
         
         if response.status_code == 200:
@@ -40,7 +42,7 @@ def send_data_to_cloud(data):
 def test_health_check():
     """ヘルスチェックエンドポイントをテスト"""
     try:
-        response = requests.get(f"{CLOUD_API_URL}/health", timeout=10)
+        response = http_transport.get(f"{CLOUD_API_URL}/health")
         if response.status_code == 200:
             print("✅ ヘルスチェック成功")
             data = response.json()
@@ -57,7 +59,7 @@ def test_health_check():
 def get_current_data():
     """現在のダッシュボードデータを取得"""
     try:
-        response = requests.get(f"{CLOUD_API_URL}/api/data", timeout=10)
+        response = http_transport.get(f"{CLOUD_API_URL}/api/data")
         if response.status_code == 200:
             print("✅ データ取得成功")
             data = response.json()
@@ -73,6 +75,59 @@ def get_current_data():
         print(f"❌ データ取得エラー: {e}")
         return None
 
+def send_batch_to_cloud(readings):
+    """クラウドAPIに読み取り値をまとめて送信し、レスポンスのJSONを返す"""
+    try:
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {API_SECRET_KEY}'
+        }
+        
+        response = http_transport.post(
+            f"{CLOUD_API_URL}/api/update/batch",
+            json={'readings': readings},
+            headers=headers
+        )
+        
+        if response.status_code == 200:
+            return response.json()
+        print(f"❌ バッチ送信失敗: {response.status_code}")
+        print(f"   レスポンス: {response.text}")
+        return None
+        
+    except Exception as e:
+        print(f"❌ バッチ送信エラー: {e}")
+        return None
+
+def test_out_of_order_batch():
+    """遅れて届いた古いバッチで現在データが巻き戻らないことを確認"""
+    now = time.time()
+    newer = [
+        {'raw_value': 60, 'percentage': 60, 'status': 'yellow', 'timestamp': now - 3},
+        {'raw_value': 61, 'percentage': 61, 'status': 'yellow', 'timestamp': now},
+    ]
+    older = [
+        {'raw_value': 12, 'percentage': 12, 'status': 'red', 'timestamp': now - 103},
+        {'raw_value': 13, 'percentage': 13, 'status': 'red', 'timestamp': now - 100},
+    ]
+    
+    result = send_batch_to_cloud(newer)
+    if not result or result.get('accepted') != len(newer):
+        print(f"❌ 新しいバッチが反映されませんでした: {result}")
+        return False
+    
+    result = send_batch_to_cloud(older)
+    if not result or result.get('accepted') != 0 or result.get('stale') != len(older):
+        print(f"❌ 古いバッチが反映されました: {result}")
+        return False
+    
+    data = get_current_data()
+    if not data or data.get('percentage') != 61:
+        print("❌ 古いバッチで現在データが巻き戻りました")
+        return False
+    print("✅ 古いバッチは反映されず、現在データは最新のまま")
+    return True
+
 def run_test_scenario():
     """様々な水分レベルでテストシナリオを実行"""
     test_scenarios = [
@@ -160,6 +215,9 @@ def main():
     if user_input.lower() in ['y', 'yes', 'はい']:
         run_test_scenario()
         
+        print("\n4. 順序が逆転したバッチの送信テスト")
+        test_out_of_order_batch()
+        
         print("\n🎉 テスト完了！")
         print(f"📊 ダッシュボードを確認してください: {CLOUD_API_URL}")
         print("💡 友人にURLを共有できます！")
@@ -173,6 +231,9 @@ def main():
     if user_input.lower() in ['y', 'yes', 'はい']:
         print("   - テストデータ送信")
     
+    print("\n🔌 接続統計:")
+    print(http_transport.format_stats())
+    
     print("\n🔗 次のステップ:")
     print("1. Arduinoを接続してlocal_sensor.pyを実行")
     print("2. 友人にダッシュボードURLを共有")
@@ -0,0 +1,108 @@
+"""AquaSync キャラクターのセリフキャッシュ
+
+セリフは水分レベルと状態だけで決まるので、(状態, 水分レベルの区間) ごとに
+まとめて生成したセリフをJSONファイルに保存しておき、読み取りのたびに
+その中からランダムに選ぶ。生成から ttl 秒過ぎた区間は作り直しが必要と判定し、
+区間の数が max_keys を超えたら最近使っていないものから捨てる。
+セリフ中の {percentage} は選んだときの水分レベルに置き換える。
+"""
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+PLACEHOLDER = '{percentage}'
+
+class MessageCache:
+    """(状態, 区間) -> セリフ一覧 のLRUキャッシュ（ファイルに保存）"""
+
+    def __init__(self, path, ttl=24 * 3600, max_keys=64, bucket_size=10):
+        self.path = path
+        self.ttl = ttl
+        self.max_keys = max(1, max_keys)
+        self.bucket_size = max(1, bucket_size)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # キー -> {'messages', 'refreshed_at', 'last'}
+        self._random = random.Random()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"⚠️ セリフキャッシュを読み込めません（作り直します）: {e}")
+            return
+        # 保存時の並び（古く使われた順）をそのままLRUの順番にする
+        for key, entry in saved.items():
+            messages = [message for message in entry.get('messages', []) if isinstance(message, str)]
+            if messages:
+                self._entries[key] = {'messages': messages, 'refreshed_at': float(entry.get('refreshed_at', 0)), 'last': None}
+
+    def _save_locked(self):
+        """一時ファイルに書いてから置き換える（書き込み途中で落ちても壊れない）"""
+        saved = {key: {'messages': entry['messages'], 'refreshed_at': entry['refreshed_at']}
+                 for key, entry in self._entries.items()}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(saved, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ セリフキャッシュを保存できません: {e}")
+
+    def bucket(self, percentage):
+        """水分レベルの区間の下限（bucket_size=10 なら 0, 10, ..., 100）"""
+        return int(percentage) // self.bucket_size * self.bucket_size
+
+    def bucket_range(self, bucket):
+        """区間に含まれる水分レベルの範囲 (下限, 上限)"""
+        return bucket, min(100, bucket + self.bucket_size - 1)
+
+    def key(self, status, percentage):
+        return f"{status}:{self.bucket(percentage)}"
+
+    def pick(self, status, percentage):
+        """(セリフ, 作り直しが必要か) を返す（キャッシュになければ (None, True)）
+
+        同じ区間で続けて同じセリフにならないよう、前回以外から選ぶ。
+        """
+        key = self.key(status, percentage)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, True
+            self._entries.move_to_end(key)
+            messages = entry['messages']
+            choices = [index for index in range(len(messages)) if index != entry['last']] or [0]
+            index = self._random.choice(choices)
+            entry['last'] = index
+            stale = time.time() - entry['refreshed_at'] >= self.ttl
+        return messages[index].replace(PLACEHOLDER, str(percentage)), stale
+
+    def needs_refresh(self, status, percentage):
+        """キャッシュにない・ttlを過ぎた区間ならTrue"""
+        with self._lock:
+            entry = self._entries.get(self.key(status, percentage))
+            return entry is None or time.time() - entry['refreshed_at'] >= self.ttl
+
+    def store(self, status, percentage, messages):
+        """区間のセリフ一覧を置き換えて保存"""
+        messages = [message for message in messages if message]
+        if not messages:
+            return
+        key = self.key(status, percentage)
+        with self._lock:
+            self._entries[key] = {'messages': messages, 'refreshed_at': time.time(), 'last': None}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+            self._save_locked()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
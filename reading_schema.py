@@ -0,0 +1,73 @@
+"""AquaSync 受信データの検証
+
+/api/update と /api/update/batch で受け付ける項目と、項目ごとの型・範囲・長さ。
+知らない項目や長すぎる文字列は受け付けないので、現在データの大きさが一定に収まる。
+検証関数は起動時に項目ごとに作っておき、受信時は辞書を引いて呼ぶだけにする。
+"""
+import math
+
+STATUSES = ('unknown', 'red', 'yellow', 'green')
+MAX_TIMESTAMP = 4102444800  # 2100-01-01
+
+def _number(minimum, maximum, integer=False):
+    """minimum〜maximum の数値（integer=True なら整数のみ）"""
+    types = int if integer else (int, float)
+    kind = 'an integer' if integer else 'a number'
+
+    def check(value):
+        # bool は int のサブクラスなので明示的に除く
+        if isinstance(value, bool) or not isinstance(value, types):
+            return f'must be {kind}'
+        if not math.isfinite(value) or not minimum <= value <= maximum:
+            return f'must be between {minimum} and {maximum}'
+        return None
+    return check
+
+def _text(max_length, nullable=False):
+    """max_length 文字以下の文字列"""
+    def check(value):
+        if value is None and nullable:
+            return None
+        if not isinstance(value, str):
+            return 'must be a string'
+        if len(value) > max_length:
+            return f'must be at most {max_length} characters'
+        return None
+    return check
+
+def _choice(choices):
+    """choices のいずれかの文字列"""
+    allowed = frozenset(choices)
+    message = f"must be one of {', '.join(choices)}"
+
+    def check(value):
+        return None if isinstance(value, str) and value in allowed else message
+    return check
+
+# 項目名 -> 検証関数（エラーならメッセージ、問題なければNoneを返す）
+FIELDS = {
+    'raw_value': _number(0, 65535, integer=True),
+    'percentage': _number(0, 100),
+    'status': _choice(STATUSES),
+    'message': _text(200),
+    'character_message': _text(500),
+    'character_face': _text(32),
+    'last_update': _text(32, nullable=True),
+    'device_id': _text(64),
+    'timestamp': _number(0, MAX_TIMESTAMP),
+}
+
+def validate_reading(reading, require_timestamp=False):
+    """読み取り値1件を検証し、問題があればエラーメッセージを返す（問題なければNone）"""
+    if not isinstance(reading, dict):
+        return 'must be an object'
+    for key, value in reading.items():
+        check = FIELDS.get(key)
+        if check is None:
+            return f"has unknown field '{key[:64]}'"
+        error = check(value)
+        if error:
+            return f"field '{key}' {error}"
+    if require_timestamp and 'timestamp' not in reading:
+        return "field 'timestamp' is required"
+    return None
@@ -0,0 +1,106 @@
+"""AquaSync クラウド未送信データの保存キュー
+
+クラウドに送れなかった読み取り値をSQLite（WALモード）に追記し、
+クラウドが復帰したら計測時刻の古い順にまとめて再送する。件数と保存期間で容量を抑える。
+サーバーが内容を理由に拒否した行は再送し続けないよう rejected テーブルに移す。
+"""
+import json
+import sqlite3
+import threading
+import time
+
+class SensorOutbox:
+    """追記専用の未送信データキュー"""
+
+    def __init__(self, path, max_rows=50000, max_age=72 * 3600):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' ts REAL NOT NULL,'
+            ' payload TEXT NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS outbox_ts ON outbox (ts, id)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS rejected ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' ts REAL NOT NULL,'
+            ' payload TEXT NOT NULL,'
+            ' rejected_at REAL NOT NULL)'
+        )
+
+    def append(self, readings):
+        """読み取り値（timestamp付きdict）を追記し、保持上限を適用"""
+        rows = [(reading.get('timestamp', time.time()), json.dumps(reading, ensure_ascii=False))
+                for reading in readings]
+        with self._lock:
+            with self._conn:
+                self._conn.executemany('INSERT INTO outbox (ts, payload) VALUES (?, ?)', rows)
+            self._enforce_retention()
+
+    def peek(self, limit):
+        """計測時刻の古い順に最大limit件を (idリスト, 読み取り値リスト) で返す
+
+        複数台の読み取り値が混ざっていても、1回分の中で時刻が前後しないようにする。
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, payload FROM outbox ORDER BY ts, id LIMIT ?', (limit,)
+            ).fetchall()
+        return [row_id for row_id, _ in rows], [json.loads(payload) for _, payload in rows]
+
+    def ack(self, ids):
+        """送信済みの行を削除"""
+        with self._lock:
+            with self._conn:
+                self._conn.executemany('DELETE FROM outbox WHERE id = ?', [(row_id,) for row_id in ids])
+
+    def reject(self, ids):
+        """サーバーに拒否された行を rejected テーブルに移す（以後は再送しない）"""
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                for row_id in ids:
+                    self._conn.execute(
+                        'INSERT INTO rejected (ts, payload, rejected_at)'
+                        ' SELECT ts, payload, ? FROM outbox WHERE id = ?', (now, row_id)
+                    )
+                    self._conn.execute('DELETE FROM outbox WHERE id = ?', (row_id,))
+            self._enforce_retention()
+
+    def rejected_count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM rejected').fetchone()[0]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def _enforce_retention(self):
+        """古すぎる行と上限を超えた行を削除（ロック取得済みで呼ぶ）"""
+        with self._conn:
+            expired = self._conn.execute(
+                'DELETE FROM outbox WHERE ts < ?', (time.time() - self.max_age,)
+            ).rowcount
+            overflow = self._conn.execute(
+                'DELETE FROM outbox WHERE id <= (SELECT MAX(id) FROM outbox) - ?', (self.max_rows,)
+            ).rowcount
+            # 拒否された行は調査用なので、同じ期間・件数の範囲で残す
+            self._conn.execute('DELETE FROM rejected WHERE rejected_at < ?', (time.time() - self.max_age,))
+            self._conn.execute(
+                'DELETE FROM rejected WHERE id <= (SELECT MAX(id) FROM rejected) - ?', (self.max_rows,)
+            )
+        if expired or overflow:
+            self._conn.execute('PRAGMA incremental_vacuum')
+            print(f"🗑️ 未送信データを破棄: 期限切れ {expired}件 / 上限超過 {overflow}件")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
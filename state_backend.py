@@ -0,0 +1,211 @@
+"""AquaSync ダッシュボードの共有状態
+
+現在データを (バージョン, 更新時刻, データ) のスナップショットとして保持する。
+gunicorn の複数ワーカーから同じ状態を見られるよう、保存先を切り替えられる。
+
+- memory: プロセス内のみ（1ワーカー用）
+- mmap:   共有メモリ上のファイル。書き込みは flock で直列化し、読み取りは
+          シーケンス番号（seqlock）で書き込み途中の状態を読まないようにする
+- redis:  Redis互換サーバー（REDIS_URL）。別ホストのワーカーとも共有できる
+"""
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 設定
+_SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+STATE_MMAP_PATH = os.getenv('STATE_MMAP_PATH', os.path.join(_SHM_DIR, 'aquasync_state'))
+STATE_MMAP_SIZE = int(os.getenv('STATE_MMAP_SIZE', str(64 * 1024)))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_KEY = os.getenv('REDIS_STATE_KEY', 'aquasync:state')
+
+class MemoryStateBackend:
+    """プロセス内だけの状態"""
+    shared = False
+
+    def __init__(self, initial):
+        self._lock = threading.Lock()
+        self._snapshot = (0, time.time(), dict(initial))
+
+    def version(self):
+        return self._snapshot[0]
+
+    def snapshot(self):
+        return self._snapshot
+
+    def update(self, mutate):
+        """mutate(データのコピー) が返したデータを次のバージョンとして保存"""
+        with self._lock:
+            version, _, data = self._snapshot
+            self._snapshot = (version + 1, time.time(), mutate(dict(data)))
+            return self._snapshot
+
+    def close(self):
+        pass
+
+# ヘッダー: シーケンス番号, バージョン, 更新時刻, データ長（以降にJSON本文）
+_SEQ = struct.Struct('<Q')
+_HEADER = struct.Struct('<QQdI')
+_READ_ATTEMPTS = 1000
+
+class MmapStateBackend:
+    """共有メモリ上のファイルに置く状態（同一ホストの複数プロセスで共有）"""
+    shared = True
+
+    def __init__(self, initial, path=STATE_MMAP_PATH, size=STATE_MMAP_SIZE):
+        if fcntl is None:
+            raise RuntimeError('mmap backend requires fcntl (POSIX)')
+        self.path = path
+        self.size = size
+        self._thread_lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._cache = None  # (シーケンス番号, スナップショット)
+        with self._locked():
+            if self._read_locked() is None:
+                self._write_locked(0, time.time(), dict(initial))
+
+    @contextmanager
+    def _locked(self):
+        """書き込み側のロック（flockはプロセス間、スレッドロックは同一プロセス内）"""
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _read_locked(self):
+        """ロック取得済みで読む（未初期化・壊れた領域ならNone）"""
+        _, version, updated_at, length = _HEADER.unpack_from(self._map, 0)
+        if length == 0:
+            return None
+        try:
+            return version, updated_at, json.loads(self._map[_HEADER.size:_HEADER.size + length])
+        except ValueError:
+            return None
+
+    def _write_locked(self, version, updated_at, data):
+        body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        if _HEADER.size + len(body) > self.size:
+            raise ValueError(f'state is too large for the shared region ({len(body)} bytes)')
+        # シーケンス番号が奇数の間は書き込み中（読み手はやり直す）
+        seq = _SEQ.unpack_from(self._map, 0)[0] | 1
+        _SEQ.pack_into(self._map, 0, seq)
+        self._map[_HEADER.size:_HEADER.size + len(body)] = body
+        struct.pack_into('<QdI', self._map, _SEQ.size, version, updated_at, len(body))
+        _SEQ.pack_into(self._map, 0, seq + 1)
+        self._cache = None
+
+    def version(self):
+        return self.snapshot()[0]
+
+    def snapshot(self):
+        """書き込みと重ならなかった読み取り結果を返す（変化がなければデコード済みを再利用）"""
+        for _ in range(_READ_ATTEMPTS):
+            seq = _SEQ.unpack_from(self._map, 0)[0]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            cached = self._cache
+            if cached is not None and cached[0] == seq:
+                return cached[1]
+            _, version, updated_at, length = _HEADER.unpack_from(self._map, 0)
+            body = self._map[_HEADER.size:_HEADER.size + length]
+            if _SEQ.unpack_from(self._map, 0)[0] != seq:
+                continue
+            snapshot = (version, updated_at, json.loads(body))
+            self._cache = (seq, snapshot)
+            return snapshot
+
+        # 書き込み中のまま進まない（書き手が異常終了した）場合はロックを取って読む
+        with self._locked():
+            snapshot = self._read_locked()
+            if snapshot is None:
+                raise RuntimeError(f'shared state at {self.path} is corrupted')
+            self._write_locked(*snapshot)
+            return snapshot
+
+    def update(self, mutate):
+        with self._locked():
+            version, _, data = self._read_locked()
+            snapshot = (version + 1, time.time(), mutate(data))
+            self._write_locked(*snapshot)
+            return snapshot
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+class RedisStateBackend:
+    """Redis互換サーバーに置く状態（バージョン・更新時刻・JSONをハッシュで保持）
+
+    client にはredis-pyと同じインターフェースのクライアント（fakeredis等）も渡せる。
+    """
+    shared = True
+
+    def __init__(self, initial, url=REDIS_URL, key=REDIS_KEY, client=None):
+        import redis  # オプション依存なので使うときだけ読み込む
+        self._redis = redis
+        self.key = key
+        self._initial = dict(initial)
+        self._client = client or redis.Redis.from_url(url)
+        self._client.hsetnx(key, 'version', 0)
+
+    def version(self):
+        return int(self._client.hget(self.key, 'version') or 0)
+
+    def _decode(self, version, updated_at, body):
+        data = json.loads(body) if body else dict(self._initial)
+        return int(version or 0), float(updated_at or 0) or time.time(), data
+
+    def snapshot(self):
+        return self._decode(*self._client.hmget(self.key, 'version', 'updated_at', 'data'))
+
+    def update(self, mutate):
+        """WATCHで楽観ロックし、他のワーカーと競合したらやり直す"""
+        with self._client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.key)
+                    version, _, data = self._decode(*pipe.hmget(self.key, 'version', 'updated_at', 'data'))
+                    snapshot = (version + 1, time.time(), mutate(data))
+                    pipe.multi()
+                    pipe.hset(self.key, mapping={
+                        'version': snapshot[0],
+                        'updated_at': snapshot[1],
+                        'data': json.dumps(snapshot[2], ensure_ascii=False),
+                    })
+                    pipe.execute()
+                    return snapshot
+                except self._redis.WatchError:
+                    continue
+
+    def close(self):
+        self._client.close()
+
+def create_backend(name, initial):
+    """名前から状態バックエンドを作成（使えない場合はプロセス内に切り替える）"""
+    if name == 'memory':
+        return MemoryStateBackend(initial)
+    if name == 'mmap':
+        if fcntl is None:
+            print("⚠️ この環境では mmap 状態共有を使えません。プロセス内の状態を使います")
+            return MemoryStateBackend(initial)
+        return MmapStateBackend(initial)
+    if name == 'redis':
+        return RedisStateBackend(initial)
+    raise ValueError(f"Unknown STATE_BACKEND: {name}")
@@ -0,0 +1,99 @@
+"""AquaSync 静的ファイルのメモリ内キャッシュ
+
+画像・音声を起動時にまとめて読み込み、ETagと（効果があれば）gzip圧縮版を
+前もって作っておく。リクエスト時は辞書を引くだけでファイルシステムには触れない。
+URLに内容のバージョン（?v=）を付けたものは immutable として長期キャッシュさせる。
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from datetime import datetime, timezone
+
+from flask import Response, abort, request
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+MIMETYPES = {'.wav': 'audio/wav', '.avif': 'image/avif', '.webp': 'image/webp'}
+COMPRESSIBLE_TYPES = ('audio/wav', 'text/', 'application/json', 'image/svg+xml')
+MIN_COMPRESSION_SAVING = 0.1  # これ以上小さくならなければ圧縮版を持たない
+
+class StaticAsset:
+    """メモリ上の静的ファイル1件"""
+    __slots__ = ('body', 'gzip_body', 'mimetype', 'etag', 'version', 'last_modified')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.body = f.read()
+        extension = os.path.splitext(path)[1].lower()
+        self.mimetype = MIMETYPES.get(extension) or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.etag = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+        self.version = self.etag[:12]
+        self.last_modified = datetime.fromtimestamp(int(os.path.getmtime(path)), timezone.utc)
+
+        self.gzip_body = None
+        if self.mimetype.startswith(COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(self.body, compresslevel=9, mtime=0)
+            if len(compressed) <= len(self.body) * (1 - MIN_COMPRESSION_SAVING):
+                self.gzip_body = compressed
+
+class AssetTable:
+    """URLの接頭辞とファイル名から StaticAsset を引く表"""
+
+    def __init__(self):
+        self._assets = {}
+
+    def load_directory(self, prefix, directory, names=None):
+        """ディレクトリのファイル（namesを指定すればその一覧だけ）を読み込んで接頭辞ごと置き換える"""
+        if names is None:
+            names = [name for name in os.listdir(directory)
+                     if not name.startswith('.') and os.path.isfile(os.path.join(directory, name))]
+        loaded = {(prefix, name): StaticAsset(os.path.join(directory, name)) for name in names}
+        # 読み込み中も配信できるよう、新しい表を作ってから差し替える
+        assets = {key: asset for key, asset in self._assets.items() if key[0] != prefix}
+        assets.update(loaded)
+        self._assets = assets
+        return len(loaded)
+
+    def get(self, prefix, name):
+        return self._assets.get((prefix, name))
+
+    def url(self, prefix, name):
+        """内容のバージョン付きURL（未登録ならバージョンなし）"""
+        asset = self._assets.get((prefix, name))
+        if asset is None:
+            return f"/{prefix}/{name}"
+        return f"/{prefix}/{name}?v={asset.version}"
+
+    def total_bytes(self):
+        return sum(len(asset.body) + len(asset.gzip_body or b'') for asset in self._assets.values())
+
+    def serve(self, prefix, name, immutable=False):
+        """条件付きGET・Range対応のレスポンスを返す
+
+        immutable=True（ファイル名にハッシュを含む場合）か、?v= が現在の内容と
+        一致する場合は長期キャッシュさせ、それ以外は毎回ETagで再検証させる。
+        """
+        asset = self._assets.get((prefix, name))
+        if asset is None:
+            abort(404)
+
+        # Range要求は元の内容に対するバイト位置なので圧縮版は使わない
+        use_gzip = asset.gzip_body is not None and request.range is None and 'gzip' in request.accept_encodings
+        body = asset.gzip_body if use_gzip else asset.body
+        response = Response(body, mimetype=asset.mimetype)
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+            response.set_etag(asset.etag + '-gz')
+        else:
+            response.set_etag(asset.etag)
+        if asset.gzip_body is not None:
+            response.vary.add('Accept-Encoding')
+        response.last_modified = asset.last_modified
+
+        if immutable or request.args.get('v') == asset.version:
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(body))
@@ -1,15 +1,55 @@
+import hashlib
 import os
-from flask import Flask, render_template_string, jsonify, request, abort, send_file
-from datetime import datetime
+import threading
+import time
+from types import MappingProxyType
+from flask import Flask, Response, render_template_string, jsonify, request, abort, g, stream_with_context
+from datetime import datetime, timezone
+
+import image_variants
+import metrics
+from dashboard_store import ReadingStore
+from history_buffer import HistoryBuffer
+from reading_schema import validate_reading
+from state_backend import create_backend
+from static_assets import AssetTable
 
 # Flaskアプリ設定
 app = Flask(__name__)
 
 # 環境変数から設定を取得
 API_SECRET_KEY = os.getenv('API_SECRET_KEY', 'aquasync-secret-key-2024')
+MAX_BATCH_READINGS = int(os.getenv('MAX_BATCH_READINGS', '500'))  # 1回のバッチで受け付ける最大件数
+# 表示する鉢の device_id（複数の Arduino を監視している場合に指定。他の鉢の読み取り値は反映しない）
+DASHBOARD_DEVICE_ID = os.getenv('DASHBOARD_DEVICE_ID')
+MAX_REQUEST_BYTES = int(os.getenv('MAX_REQUEST_BYTES', str(512 * 1024)))  # リクエスト本文の上限（超えたら413）
+HISTORY_CAPACITY = int(os.getenv('HISTORY_CAPACITY', str(7 * 24 * 3600 // 3)))  # 3秒間隔で1週間分
+HISTORY_DEFAULT_RANGE = 24 * 3600  # /api/history の既定期間（秒）
+HISTORY_MAX_POINTS = 2000
+LONG_POLL_TIMEOUT = float(os.getenv('LONG_POLL_TIMEOUT', '25'))  # /api/data?wait_for= の最大待ち時間（秒）
+SSE_HEARTBEAT = float(os.getenv('SSE_HEARTBEAT', '15'))  # /api/stream の生存確認コメント間隔（秒）
+SSE_MAX_CLIENTS = int(os.getenv('SSE_MAX_CLIENTS', '1000'))  # 同時接続の上限
+SSE_RETRY_MS = 3000  # 切断時にブラウザが再接続するまでの待ち時間
+DASHBOARD_DB_PATH = os.getenv('DASHBOARD_DB_PATH', 'aquasync_dashboard.db')  # 空にすると履歴を永続化しない
+DAY = 24 * 3600
+STORE_RETENTION = {
+    'raw': float(os.getenv('RETENTION_RAW_DAYS', '7')) * DAY,
+    'rollup_minute': float(os.getenv('RETENTION_MINUTE_DAYS', '90')) * DAY,
+    'rollup_hour': float(os.getenv('RETENTION_HOUR_DAYS', '730')) * DAY,
+    'rollup_day': float(os.getenv('RETENTION_DAY_DAYS', '0')) * DAY,  # 0は無期限
+}
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+VOICE_DIR = os.path.join(BASE_DIR, 'voice')
+IMAGE_VARIANTS_AUTOBUILD = os.getenv('IMAGE_VARIANTS_AUTOBUILD', 'true').lower() == 'true'  # 起動時に画像バリアントを生成
+CHARACTER_IMAGE_SIZES = '(max-width: 800px) 100vw, 800px'  # キャラクター画像の表示幅
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')  # memory / mmap / redis（複数ワーカーでは mmap か redis）
+STATE_POLL_INTERVAL = float(os.getenv('STATE_POLL_INTERVAL', '0.1'))  # 他ワーカーの更新を確認する間隔（秒）
 
-# グローバル変数でデータを保存（メモリ内ストレージ）
-current_data = {
+# 受信するリクエスト本文の大きさを制限
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+
+# 初期データ
+DEFAULT_DATA = {
     'raw_value': 0,
     'percentage': 0,
     'status': 'unknown',
@@ -19,6 +59,144 @@ current_data = {
     'character_face': 'normal'
 }
 
+# 共有状態の中で鉢ごとの最後に反映した計測時刻を持つキー（/api/data には出さない）
+APPLIED_KEY = '_applied'
+
+class DataSnapshot:
+    """ある時点の現在データ（作成後は変更しない）
+    
+    /api/data と /health の本文は作成時にJSON化しておき、リクエストごとには直列化しない。
+    """
+    __slots__ = ('version', 'updated_at', 'data', 'applied', 'body', 'etag', 'health_parts')
+    
+    def __init__(self, version, updated_at, data):
+        data = dict(data)
+        self.version = version
+        self.updated_at = datetime.fromtimestamp(int(updated_at), timezone.utc)
+        self.applied = MappingProxyType(data.pop(APPLIED_KEY, None) or {})
+        self.data = MappingProxyType(data)
+        self.body = app.json.dumps(dict(data, version=version)).encode('utf-8')
+        self.etag = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+        
+        # /health は時刻だけがリクエストごとに変わるので、その前後を分けて持つ
+        health = app.json.dumps({
+            'status': 'healthy',
+            'timestamp': '__TIMESTAMP__',
+            'last_sensor_update': data.get('last_update'),
+            'current_status': data.get('status', 'unknown')
+        }).encode('utf-8')
+        self.health_parts = tuple(health.split(b'"__TIMESTAMP__"'))
+    
+    def health_body(self, now):
+        before, after = self.health_parts
+        return b'%s"%s"%s' % (before, now.isoformat().encode('ascii'), after)
+
+# 現在データの保存先（ワーカー間で共有できるバックエンドを選べる）
+state = create_backend(STATE_BACKEND, DEFAULT_DATA)
+
+# 更新処理の直列化用ロック
+update_lock = threading.Lock()
+
+# このプロセスが表示に使う現在データ（更新のたびに新しいスナップショットへ参照ごと差し替える）
+current = DataSnapshot(*state.snapshot())
+
+data_changed = threading.Condition()
+
+# 描画済みダッシュボード (バージョン, 本文, ETag, 更新時刻)
+_page_cache = None
+
+# /api/stream の接続数
+stream_clients = 0
+stream_clients_lock = threading.Lock()
+
+# メトリクス（/metrics で出力、ワーカーごとの値）
+REQUEST_DURATION = metrics.histogram(
+    'aquasync_http_request_duration_seconds', 'HTTPリクエストの処理時間', ('route', 'method'))
+REQUESTS = metrics.counter('aquasync_http_requests_total', 'HTTPリクエスト数', ('route', 'method', 'status'))
+INGEST_BYTES = metrics.histogram(
+    'aquasync_ingest_payload_bytes', '受信したデータの本文サイズ', ('endpoint',),
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 524288))
+READINGS_INGESTED = metrics.counter('aquasync_readings_ingested_total', '反映した読み取り値の件数', ('endpoint',))
+INGEST_REJECTED = metrics.counter('aquasync_ingest_rejected_total', '受け付けなかった更新リクエスト', ('endpoint', 'status'))
+READINGS_IGNORED = metrics.counter('aquasync_readings_ignored_total', '表示対象外の鉢のため反映しなかった読み取り値の件数', ('endpoint',))
+READINGS_STALE = metrics.counter('aquasync_readings_stale_total', '反映済みより古いため反映しなかった読み取り値の件数', ('endpoint',))
+metrics.gauge('aquasync_data_version', '現在データのバージョン').set_function(lambda: current.version)
+metrics.gauge('aquasync_stream_clients', '/api/stream の接続数').set_function(lambda: stream_clients)
+metrics.gauge('aquasync_history_samples', 'メモリ内履歴のサンプル数').set_function(lambda: len(history))
+INGEST_ENDPOINTS = {'update_data': 'update', 'update_batch': 'batch'}
+
+# 読み取り値の履歴（直近はメモリ内リングバッファ、長期はSQLite）
+history = HistoryBuffer(HISTORY_CAPACITY)
+store = ReadingStore(DASHBOARD_DB_PATH, STORE_RETENTION) if DASHBOARD_DB_PATH else None
+
+# 再起動しても直近の履歴をすぐ返せるようにリングバッファへ復元
+if store is not None:
+    for timestamp, raw_value, percentage, status in store.recent(time.time() - STORE_RETENTION['raw']):
+        history.append(timestamp, raw_value or 0, percentage, status)
+
+# 画像・音声はメモリに読み込んでおき、リクエスト時はファイルシステムに触れない
+assets = AssetTable()
+assets.load_directory('img', image_variants.IMAGE_DIR)
+assets.load_directory('voice', VOICE_DIR)
+
+def load_image_variants(manifest):
+    """マニフェストにあるバリアントだけをメモリに読み込む"""
+    names = [name for entry in manifest.values() for variants in entry['sources'].values() for name, _ in variants]
+    try:
+        assets.load_directory('img/v', image_variants.IMAGE_CACHE_DIR, names)
+    except OSError as e:
+        print(f"画像バリアント読み込みエラー: {e}")
+        return {}
+    return manifest
+
+def build_image_table(manifest):
+    """テンプレート用の画像情報 {ファイル名: {'src', 'width', 'height', 'sources'}} を作る"""
+    images = {}
+    for filename in sorted(os.listdir(image_variants.IMAGE_DIR)):
+        entry = manifest.get(filename, {})
+        sources = [
+            {
+                'type': mimetype,
+                'srcset': ', '.join(f"/img/v/{name} {width}w" for name, width in variants),
+                'variants': variants,
+            }
+            for mimetype, variants in entry.get('sources', {}).items()
+        ]
+        images[filename] = {
+            'src': assets.url('img', filename),
+            'width': entry.get('width'),
+            'height': entry.get('height'),
+            'sources': sources,
+        }
+    return images
+
+def background_image_set(filename, min_width):
+    """min_width以上で最小のバリアントを並べたCSSの image-set()（バリアントがなければNone）"""
+    candidates = []
+    for source in images[filename]['sources']:
+        variants = source['variants']
+        name = next((name for name, width in variants if width >= min_width), variants[-1][0])
+        candidates.append(f'url("/img/v/{name}") type("{source["type"]}")')
+    return f"image-set({', '.join(candidates)})" if candidates else None
+
+# 生成済みの画像バリアント（元画像ごとのAVIF/WebP・幅違い）
+images = build_image_table(load_image_variants(image_variants.load_manifest() or {}))
+voice_urls = {name: assets.url('voice', name) for name in sorted(os.listdir(VOICE_DIR))}
+
+def refresh_image_variants():
+    """足りないバリアントを生成し、ダッシュボードを新しい画像で描画し直す"""
+    global images, _page_cache
+    try:
+        manifest = image_variants.build_variants()
+    except Exception as e:
+        print(f"画像バリアント生成エラー: {e}")
+        return
+    images = build_image_table(load_image_variants(manifest))
+    _page_cache = None
+
+if IMAGE_VARIANTS_AUTOBUILD and image_variants.Image is not None:
+    threading.Thread(target=refresh_image_variants, name='image-variants', daemon=True).start()
+
 # HTML テンプレート（ビジュアルノベル風・音声オンオフ機能付き）
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -36,7 +214,8 @@ HTML_TEMPLATE = """
         }
         body {
             font-family: 'Hiragino Kaku Gothic Pro', 'ヒラギノ角ゴ Pro W3', Meiryo, 'メイリオ', Osaka, 'MS PGothic', sans-serif;
-            background: url('/img/back.jpg') center center / cover no-repeat fixed;
+            background: url('{{ images['back.jpg'].src }}') center center / cover no-repeat fixed;
+            {% if background_large %}background-image: {{ background_large|safe }};{% endif %}
             color: #333;
             line-height: 1.6;
             height: 100vh;
@@ -150,6 +329,7 @@ HTML_TEMPLATE = """
         }
         .character-image {
             width: 800px;
+            max-width: 100vw;
             height: auto;
             filter: drop-shadow(0 0 30px rgba(0, 0, 0, 0.6));
             transition: all 0.3s ease;
@@ -208,9 +388,16 @@ HTML_TEMPLATE = """
             font-weight: bold;
         }
         
+        /* スマートフォンでは小さい背景画像を使う */
+        @media (max-width: 800px) {
+            body {
+                {% if background_small %}background-image: {{ background_small|safe }};{% endif %}
+            }
+        }
     </style>
     <script>
         let lastUpdateTime = new Date('{{ last_update or "1970-01-01" }}').getTime();
+        let dataVersion = {{ data_version }}; // 表示中のデータのバージョン
         let lastFaceType = null; // 前回の状態を記録（音声用）
         let audioEnabled = false; // 音声の有効/無効
         let userInteracted = false; // ユーザーが操作したかのフラグ
@@ -238,7 +425,7 @@ HTML_TEMPLATE = """
         
         function playTestSound() {
             // 音声ONにした時のテスト音
-            const audio = new Audio('/voice/yorosiku.wav');
+            const audio = new Audio(voiceUrls['yorosiku.wav']);
             audio.volume = 0.7;
             audio.play().catch(e => {
                 console.log('テスト音声再生エラー:', e);
@@ -247,30 +434,67 @@ HTML_TEMPLATE = """
         }
         
         function refreshData() {
+            // EventSourceが使えればサーバーからの配信で更新
+            if (window.EventSource) {
+                const source = new EventSource('/api/stream');
+                source.addEventListener('update', e => applyData(JSON.parse(e.data)));
+                source.onerror = () => {
+                    // 接続数の上限(503)や切断でエラーになったら配信をやめてロングポーリングに切り替える
+                    console.log('ストリーム接続エラー: ロングポーリングに切り替えます');
+                    source.close();
+                    pollData();
+                };
+                return;
+            }
+            pollData();
+        }
+        
+        function pollData() {
             fetch('/api/data')
                 .then(response => response.json())
+                .then(applyData);
+            waitForData();
+        }
+        
+        function waitForData() {
+            // 新しいデータが届くまでサーバー側で待つ（変化がなければ304）
+            fetch('/api/data?wait_for=' + dataVersion, { cache: 'no-store' })
+                .then(response => response.status === 304 ? null : response.json())
                 .then(data => {
-                    // 水分量の更新
-                    document.getElementById('percentage').textContent = data.percentage + '%';
-                    
-                    // 感情マークの更新
-                    updateEmotionMark(data.character_face);
-                    
-                    // 色の更新
-                    updateColors(data.percentage, data.character_face);
-                    
-                    // 台詞ボックスの更新
-                    document.getElementById('dialogue-text').textContent = data.character_message || 'お疲れ様！';
-                    
-                    // キャラクター画像のエフェクト更新（音声付き）
-                    updateCharacterEffect(data.character_face || data.status);
-                    
-                    // ステータスに応じてクラスを更新
-                    const sidebar = document.getElementById('sidebar');
-                    sidebar.className = 'sidebar status-' + data.status;
+                    if (data) {
+                        applyData(data);
+                    }
+                    waitForData();
+                })
+                .catch(e => {
+                    console.log('データ待機エラー:', e);
+                    setTimeout(waitForData, 10000);
                 });
         }
         
+        function applyData(data) {
+            dataVersion = data.version;
+            
+            // 水分量の更新
+            document.getElementById('percentage').textContent = data.percentage + '%';
+            
+            // 感情マークの更新
+            updateEmotionMark(data.character_face);
+            
+            // 色の更新
+            updateColors(data.percentage, data.character_face);
+            
+            // 台詞ボックスの更新
+            document.getElementById('dialogue-text').textContent = data.character_message || 'お疲れ様！';
+            
+            // キャラクター画像のエフェクト更新（音声付き）
+            updateCharacterEffect(data.character_face || data.status);
+            
+            // ステータスに応じてクラスを更新
+            const sidebar = document.getElementById('sidebar');
+            sidebar.className = 'sidebar status-' + data.status;
+        }
+        
         function playVoice(faceType) {
             // 音声が有効で、ユーザーが操作済みの場合のみ再生
             if (!audioEnabled || !userInteracted) {
@@ -280,7 +504,7 @@ HTML_TEMPLATE = """
             let voiceFile = getVoiceFile(faceType);
             
             if (voiceFile) {
-                const audio = new Audio(`/voice/${voiceFile}`);
+                const audio = new Audio(voiceUrls[voiceFile] || `/voice/${voiceFile}`);
                 audio.volume = 0.7;
                 audio.play().catch(e => {
                     console.log('音声再生エラー:', e);
@@ -308,6 +532,33 @@ HTML_TEMPLATE = """
             return null;
         }
         
+        // 画像の縮小版・次世代形式の候補（srcset）
+        const characterImages = {{ images|tojson }};
+        const voiceUrls = {{ voice_urls|tojson }}; // バージョン付きの音声URL
+        const characterSizes = '{{ character_sizes }}';
+        let currentImageFile = 'yousei1.png';
+        
+        function setCharacterImage(filename) {
+            // 画像が変わった時だけ差し替え（同じ画像の再読み込みを避ける）
+            if (filename === currentImageFile || !characterImages[filename]) {
+                return;
+            }
+            currentImageFile = filename;
+            
+            const picture = document.getElementById('character-picture');
+            const characterImg = document.getElementById('character-image');
+            const image = characterImages[filename];
+            picture.querySelectorAll('source').forEach(source => source.remove());
+            image.sources.forEach(source => {
+                const element = document.createElement('source');
+                element.type = source.type;
+                element.srcset = source.srcset;
+                element.sizes = characterSizes;
+                picture.insertBefore(element, characterImg);
+            });
+            characterImg.src = image.src;
+        }
+        
         function updateCharacterEffect(faceType) {
             const characterImg = document.getElementById('character-image');
             
@@ -315,43 +566,43 @@ HTML_TEMPLATE = """
             characterImg.className = 'character-image';
             
             // 画像ファイル名に基づいて画像を切り替え
-            let imageSrc = '/img/yousei1.png'; // デフォルト
+            let imageFile = 'yousei1.png'; // デフォルト
             
             switch(faceType) {
                 case 'yousei1':
-                    imageSrc = '/img/yousei1.png';
+                    imageFile = 'yousei1.png';
                     break;
                 case 'yousei2':
-                    imageSrc = '/img/yousei2.png';
+                    imageFile = 'yousei2.png';
                     break;
                 case 'yousei4':
-                    imageSrc = '/img/yousei4.png';
+                    imageFile = 'yousei4.png';
                     characterImg.classList.add('happy');
                     break;
                 case 'yousei5':
-                    imageSrc = '/img/yousei5.png';
+                    imageFile = 'yousei5.png';
                     characterImg.classList.add('sad');
                     break;
                 case 'green':
                 case 'happy':
-                    imageSrc = '/img/yousei4.png';
+                    imageFile = 'yousei4.png';
                     characterImg.classList.add('happy');
                     faceType = 'yousei4'; // 音声用に正規化
                     break;
                 case 'red':
                 case 'sad':
-                    imageSrc = '/img/yousei5.png';
+                    imageFile = 'yousei5.png';
                     characterImg.classList.add('sad');
                     faceType = 'yousei5'; // 音声用に正規化
                     break;
                 default:
-                    imageSrc = '/img/yousei1.png';
+                    imageFile = 'yousei1.png';
                     faceType = 'yousei1'; // 音声用に正規化
                     break;
             }
             
             // 画像を更新
-            characterImg.src = imageSrc;
+            setCharacterImage(imageFile);
             
             // 状態が変わった時だけ音声再生（音声ON時のみ）
             if (lastFaceType !== faceType) {
@@ -403,10 +654,7 @@ HTML_TEMPLATE = """
             }
         }
         
-        // 10秒ごとに自動更新
-        setInterval(refreshData, 10000);
-        
-        // ページ読み込み時に1回実行
+        // ページ読み込み時に1回実行し、その後は更新を待ち受ける
         window.onload = function() {
             refreshData();
         };
@@ -439,7 +687,13 @@ HTML_TEMPLATE = """
     
     <!-- キャラクター表示エリア -->
     <div class="character-area">
-        <img id="character-image" src="/img/yousei1.png" alt="エモたん" class="character-image {{ character_face }}">
+        <picture id="character-picture">
+            {% for source in images['yousei1.png'].sources %}
+            <source type="{{ source.type }}" srcset="{{ source.srcset }}" sizes="{{ character_sizes }}">
+            {% endfor %}
+            <img id="character-image" src="{{ images['yousei1.png'].src }}" alt="エモたん" class="character-image {{ character_face }}"
+                 {% if images['yousei1.png'].width %}width="{{ images['yousei1.png'].width }}" height="{{ images['yousei1.png'].height }}"{% endif %}>
+        </picture>
     </div>
     
     <!-- 台詞ボックス -->
@@ -455,6 +709,27 @@ HTML_TEMPLATE = """
 </html>
 """
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """ルートごとの処理時間・件数と、更新リクエストの本文サイズを記録"""
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    started = g.get('request_started')
+    if started is not None:
+        REQUEST_DURATION.observe(time.perf_counter() - started, route=route, method=request.method)
+    REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    
+    endpoint = INGEST_ENDPOINTS.get(request.endpoint)
+    if endpoint is not None:
+        if request.content_length is not None:
+            INGEST_BYTES.observe(request.content_length, endpoint=endpoint)
+        if response.status_code >= 400:
+            INGEST_REJECTED.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
 def authenticate_request():
     """API リクエストの認証"""
     auth_header = request.headers.get('Authorization')
@@ -464,15 +739,238 @@ def authenticate_request():
     token = auth_header.split('Bearer ')[-1]
     return token == API_SECRET_KEY
 
+def publish_state(version, updated_at, data):
+    """状態のスナップショットをこのプロセスの現在データに反映し、待機中のリクエストを起こす"""
+    global current
+    if version <= current.version:
+        return
+    # JSON化はロックの外で済ませておく
+    snapshot = DataSnapshot(version, updated_at, data)
+    with data_changed:
+        # 同時に届いた古いスナップショットで巻き戻さない
+        if version <= current.version:
+            return
+        # 参照の差し替えだけなので、読み手には更新前後どちらかのスナップショットだけが見える
+        current = snapshot
+        data_changed.notify_all()
+
+def sync_state():
+    """他のワーカーが書き込んだ更新があれば反映（共有バックエンドのみ）"""
+    if state.shared and state.version() != current.version:
+        publish_state(*state.snapshot())
+
+def watch_state():
+    """待機中のロングポーリング・SSEのために共有状態の変化を監視"""
+    while True:
+        time.sleep(STATE_POLL_INTERVAL)
+        try:
+            sync_state()
+        except Exception as e:
+            print(f"状態同期エラー: {e}")
+            time.sleep(1)
+
+if state.shared:
+    threading.Thread(target=watch_state, name='state-watcher', daemon=True).start()
+
+_seen_devices = set()
+
+def select_dashboard_readings(readings):
+    """このダッシュボードに反映する読み取り値だけを返す
+    
+    現在データと履歴は1鉢分しか持たないので、DASHBOARD_DEVICE_ID を指定した場合は
+    その鉢（と device_id なし）の値だけを反映する。未指定のまま複数の鉢から届いた場合は警告する。
+    """
+    if DASHBOARD_DEVICE_ID:
+        return [reading for reading in readings if reading.get('device_id', DASHBOARD_DEVICE_ID) == DASHBOARD_DEVICE_ID]
+    for reading in readings:
+        device_id = reading.get('device_id')
+        if device_id is not None and device_id not in _seen_devices:
+            _seen_devices.add(device_id)
+            if len(_seen_devices) == 2:
+                print(f"⚠️ 複数の鉢から受信しています ({', '.join(sorted(_seen_devices))})。"
+                      "表示が混ざらないよう DASHBOARD_DEVICE_ID で表示する鉢を指定してください")
+    return readings
+
+def reading_time(reading):
+    """計測時刻（なければ受信時刻）"""
+    timestamp = reading.get('timestamp')
+    return timestamp if isinstance(timestamp, (int, float)) else time.time()
+
+def is_newer(reading, timestamp, applied):
+    """その鉢で最後に反映した計測時刻より新しいか（同時刻以前の再送・遅れて届いたバッチは反映しない）"""
+    last = applied.get(reading.get('device_id') or '')
+    return last is None or timestamp > last
+
+def apply_readings(readings):
+    """読み取り値を順番に反映し、新しいデータにまとめて差し替える
+    
+    鉢ごとに最後に反映した計測時刻を共有状態に持ち、それ以前の読み取り値は
+    現在データ・履歴・SQLiteのどれにも反映しない。(現在データ, 反映した件数) を返す。
+    """
+    readings = [(reading, reading_time(reading)) for reading in readings]
+    # 明らかに古いものは共有状態を書き換える前に外す（最終判定は merge の中で行う）
+    applied = current.applied
+    readings = [(reading, timestamp) for reading, timestamp in readings if is_newer(reading, timestamp, applied)]
+    if not readings:
+        return current, 0
+    
+    samples = []
+    accepted = []
+    
+    def merge(new_data):
+        # 共有バックエンドでは競合時に再実行されるので、履歴はここでは書き込まない
+        samples.clear()
+        accepted.clear()
+        applied = dict(new_data.get(APPLIED_KEY) or {})
+        for reading, timestamp in readings:
+            if not is_newer(reading, timestamp, applied):
+                continue
+            applied[reading.get('device_id') or ''] = timestamp
+            accepted.append(reading)
+            reading = dict(reading)
+            reading.pop('timestamp', None)
+            new_data.update(reading)
+            
+            # 更新時刻を記録（計測時刻があればそれを、なければ受信時刻を使う）
+            new_data['last_update'] = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+            
+            if 'percentage' in reading:
+                raw_value = new_data.get('raw_value') or 0
+                samples.append((timestamp, raw_value, new_data['percentage'], new_data.get('status')))
+        new_data[APPLIED_KEY] = applied
+        return new_data
+    
+    with update_lock:
+        snapshot = state.update(merge)
+        for sample in samples:
+            history.append(*sample)
+            if store is not None:
+                store.add(*sample)
+    
+    # このプロセスの現在データを差し替え、ロングポーリング中のリクエストを起こす
+    publish_state(*snapshot)
+    return current, len(accepted)
+
+def get_snapshot():
+    """現在データのスナップショットを返す（共有バックエンドでは他ワーカーの更新も反映）"""
+    sync_state()
+    return current
+
+def get_dashboard_page():
+    """描画済みのダッシュボードを返す（データが更新されたときだけ描画し直す）"""
+    global _page_cache
+    snapshot = get_snapshot()
+    cached = _page_cache
+    if cached is not None and cached[0] == snapshot.version:
+        return cached
+    
+    body = render_template_string(
+        HTML_TEMPLATE,
+        data_version=snapshot.version,
+        images=images,
+        voice_urls=voice_urls,
+        character_sizes=CHARACTER_IMAGE_SIZES,
+        background_large=background_image_set('back.jpg', 1920),
+        background_small=background_image_set('back.jpg', 960),
+        **snapshot.data,
+    ).encode('utf-8')
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    cached = (snapshot.version, body, etag, snapshot.updated_at)
+    _page_cache = cached
+    return cached
+
 @app.route('/')
 def dashboard():
     """水分レベルダッシュボードを表示"""
-    return render_template_string(HTML_TEMPLATE, **current_data)
+    _, body, etag, updated_at = get_dashboard_page()
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.last_modified = updated_at
+    response.cache_control.no_cache = True  # 毎回ETagで再検証させる
+    
+    # If-None-Match / If-Modified-Since が一致すれば304を返す
+    return response.make_conditional(request)
 
 @app.route('/api/data')
 def get_data():
-    """現在の水分データをJSON形式で返す"""
-    return jsonify(current_data)
+    """現在の水分データをJSON形式で返す
+    
+    wait_for=<version> を付けると、データがそのバージョンから変わるまで
+    最大 LONG_POLL_TIMEOUT 秒待ってから返す（変化がなければ304）。
+    """
+    wait_for = request.args.get('wait_for', type=int)
+    if wait_for is not None:
+        with data_changed:
+            data_changed.wait_for(lambda: current.version != wait_for, timeout=LONG_POLL_TIMEOUT)
+    
+    snapshot = get_snapshot()
+    if wait_for is not None and snapshot.version == wait_for:
+        response = Response(status=304)
+        response.set_etag(snapshot.etag)
+        return response
+    
+    response = Response(snapshot.body, mimetype='application/json')
+    response.set_etag(snapshot.etag)
+    response.headers['X-Data-Version'] = str(snapshot.version)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/api/stream')
+def stream_data():
+    """更新をServer-Sent Eventsで配信
+    
+    各イベントは現在データ全体なので、再接続時は Last-Event-ID と
+    現在のバージョンが違えば最新データを1件送るだけで追いつける。
+    待機はデータ更新の条件変数で行い、gevent ワーカーでは接続ごとに
+    スレッドを消費しない（gunicorn.conf.py 参照）。
+    """
+    global stream_clients
+    with stream_clients_lock:
+        if stream_clients >= SSE_MAX_CLIENTS:
+            return jsonify({'error': 'Too many stream clients'}), 503
+        stream_clients += 1
+    
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    
+    def events():
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        sent_version = last_event_id
+        while True:
+            snapshot = get_snapshot()
+            if snapshot.version != sent_version:
+                yield b"id: %d\nevent: update\ndata: %s\n\n" % (snapshot.version, snapshot.body)
+                sent_version = snapshot.version
+            
+            with data_changed:
+                changed = data_changed.wait_for(lambda: current.version != sent_version, timeout=SSE_HEARTBEAT)
+            if not changed:
+                yield ": heartbeat\n\n"
+    
+    def release():
+        global stream_clients
+        with stream_clients_lock:
+            stream_clients -= 1
+    
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    # 本文を読まれないまま閉じられても接続数を戻す（WSGIサーバーは必ず close を呼ぶ）
+    response.call_on_close(release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # プロキシでのバッファリングを止める
+    return response
+
+@app.errorhandler(413)
+def request_too_large(e):
+    """本文が MAX_REQUEST_BYTES を超えたリクエスト"""
+    return jsonify({'error': f'Request body too large (max {MAX_REQUEST_BYTES} bytes)'}), 413
+
+def read_json_body():
+    """JSON本文を読み込む（失敗時は (None, エラーレスポンス)）"""
+    if not request.is_json:
+        return None, (jsonify({'error': 'Content-Type must be application/json'}), 415)
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return None, (jsonify({'error': 'Request body must be valid JSON'}), 400)
+    return payload, None
 
 @app.route('/api/update', methods=['POST'])
 def update_data():
@@ -481,20 +979,30 @@ def update_data():
     if not authenticate_request():
         abort(401)
     
+    # JSONデータを受信して検証（知らない項目・型違い・長すぎる値は受け付けない）
+    new_data, error_response = read_json_body()
+    if error_response:
+        return error_response
+    if not isinstance(new_data, dict) or not new_data:
+        return jsonify({'error': 'Request body must be a non-empty object'}), 400
+    error = validate_reading(new_data)
+    if error:
+        return jsonify({'error': f'Reading {error}'}), 422
+    
+    if not select_dashboard_readings([new_data]):
+        READINGS_IGNORED.inc(endpoint='update')
+        return jsonify({'status': 'ignored', 'message': 'Device is not shown on this dashboard'})
+    
     try:
-        # JSONデータを受信
-        new_data = request.json
-        if not new_data:
-            return jsonify({'error': 'No data provided'}), 400
-        
         # グローバルデータを更新
-        global current_data
-        current_data.update(new_data)
+        snapshot, accepted = apply_readings([new_data])
+        if not accepted:
+            READINGS_STALE.inc(endpoint='update')
+            return jsonify({'status': 'ignored', 'message': 'Reading is not newer than the current data'})
+        data = snapshot.data
+        READINGS_INGESTED.inc(endpoint='update')
         
-        # 更新時刻を記録
-        current_data['last_update'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        print(f"📊 データ受信: {current_data['percentage']}% ({current_data['status']}) | {current_data['character_message']}")
+        print(f"📊 データ受信: {data.get('percentage')}% ({data.get('status')}) | {data.get('character_message')}")
         
         return jsonify({'status': 'success', 'message': 'Data updated successfully'})
         
@@ -502,33 +1010,114 @@ def update_data():
         print(f"データ更新エラー: {e}")
         return jsonify({'error': 'Failed to update data'}), 500
 
+@app.route('/api/update/batch', methods=['POST'])
+def update_batch():
+    """ローカルセンサーでまとめた複数の読み取り値を受信"""
+    # 認証チェック
+    if not authenticate_request():
+        abort(401)
+    
+    payload, error_response = read_json_body()
+    if error_response:
+        return error_response
+    readings = payload.get('readings') if isinstance(payload, dict) else payload
+    if not isinstance(readings, list) or not readings:
+        return jsonify({'error': 'readings must be a non-empty array'}), 400
+    if len(readings) > MAX_BATCH_READINGS:
+        return jsonify({'error': f'Too many readings (max {MAX_BATCH_READINGS})'}), 413
+    
+    # 全件を検証してから適用する（途中で失敗しても一部だけ反映されないように）
+    last_timestamp = None
+    for index, reading in enumerate(readings):
+        error = validate_reading(reading, require_timestamp=True)
+        if error:
+            return jsonify({'error': f'readings[{index}] {error}'}), 422
+        timestamp = reading['timestamp']
+        if last_timestamp is not None and timestamp < last_timestamp:
+            return jsonify({'error': f'readings[{index}] is out of order'}), 400
+        last_timestamp = timestamp
+    
+    selected = select_dashboard_readings(readings)
+    ignored = len(readings) - len(selected)
+    if ignored:
+        READINGS_IGNORED.inc(ignored, endpoint='batch')
+    if not selected:
+        return jsonify({'status': 'ignored', 'accepted': 0, 'ignored': ignored, 'stale': 0})
+    
+    try:
+        snapshot, accepted = apply_readings(selected)
+        READINGS_INGESTED.inc(accepted, endpoint='batch')
+    except Exception as e:
+        print(f"バッチ更新エラー: {e}")
+        return jsonify({'error': 'Failed to update data'}), 500
+    
+    # 反映済みより古い読み取り値（遅れて届いたバッチ・再送）は反映せずに数だけ返す
+    stale = len(selected) - accepted
+    if stale:
+        READINGS_STALE.inc(stale, endpoint='batch')
+    if not accepted:
+        return jsonify({'status': 'ignored', 'accepted': 0, 'ignored': ignored, 'stale': stale})
+    
+    data = snapshot.data
+    print(f"📦 バッチ受信: {accepted}件 | 最新 {data.get('percentage')}% ({data.get('status')})")
+    
+    return jsonify({'status': 'success', 'accepted': accepted, 'ignored': ignored, 'stale': stale})
+
+@app.route('/api/history')
+def get_history():
+    """期間内の履歴を間引いて返す（from/to はUNIX秒、points は最大点数）"""
+    try:
+        end = float(request.args.get('to', time.time()))
+        start = float(request.args.get('from', end - HISTORY_DEFAULT_RANGE))
+        points = int(request.args.get('points', 500))
+    except ValueError:
+        return jsonify({'error': 'from, to and points must be numbers'}), 400
+    if start > end:
+        return jsonify({'error': 'from must not be after to'}), 400
+    points = max(1, min(points, HISTORY_MAX_POINTS))
+    
+    # 共有バックエンドでは他のワーカーが受けた読み取り値もあるのでSQLiteから読む
+    # メモリにある期間はメモリから、それより古い期間だけSQLiteのロールアップから集計する
+    oldest = history.oldest()
+    if store is not None and (state.shared or oldest is None or oldest > end):
+        source, series = store.query(start, end, points)
+    elif store is not None and start < oldest:
+        # 点数は期間の長さで按分する（境界をまたぐロールアップのバケットは捨てる）
+        store_points = min(points - 1, round(points * (oldest - start) / (end - start)))
+        source, series = 'memory', []
+        if store_points > 0:
+            table, older = store.query(start, oldest, store_points)
+            series = [entry for entry in older if entry['t'] < oldest]
+            source = f'{table}+memory'
+        series += history.query(oldest, end, points - store_points)
+    else:
+        source, series = 'memory', history.query(start, end, points)
+    return jsonify({'from': start, 'to': end, 'points': len(series), 'source': source, 'series': series})
+
 @app.route('/img/<filename>')
 def serve_image(filename):
     """ローカル画像ファイルを配信"""
-    image_path = os.path.join(os.getcwd(), 'img', filename)
-    if os.path.exists(image_path):
-        return send_file(image_path)
-    else:
-        abort(404)
+    return assets.serve('img', filename)
+
+@app.route('/img/v/<filename>')
+def serve_image_variant(filename):
+    """生成済みの画像バリアントを配信（内容ハッシュ付きの名前なので長期キャッシュ可）"""
+    return assets.serve('img/v', filename, immutable=True)
 
 @app.route('/voice/<filename>')
 def serve_voice(filename):
     """音声ファイルを配信"""
-    voice_path = os.path.join(os.getcwd(), 'voice', filename)
-    if os.path.exists(voice_path):
-        return send_file(voice_path, mimetype='audio/wav')
-    else:
-        abort(404)
+    return assets.serve('voice', filename)
+
+@app.route('/metrics')
+def get_metrics():
+    """メトリクスをPrometheusのテキスト形式で返す"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 @app.route('/health')
 def health_check():
     """ヘルスチェック用エンドポイント"""
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': datetime.now().isoformat(),
-        'last_sensor_update': current_data.get('last_update'),
-        'current_status': current_data.get('status', 'unknown')
-    })
+    return Response(get_snapshot().health_body(datetime.now()), mimetype='application/json')
 
 if __name__ == '__main__':
     print("🌐 AquaSync Cloud Dashboard 起動中...")
@@ -537,8 +1126,12 @@ if __name__ == '__main__':
     print("🔌 API エンドポイント:")
     print("  - GET  /api/data - データ取得")
     print("  - POST /api/update - データ更新（要認証）")
+    print("  - POST /api/update/batch - 複数データの一括更新（要認証）")
+    print("  - GET  /api/history - 履歴データ取得（間引き済み）")
+    print("  - GET  /api/stream - 更新のServer-Sent Events配信")
     print("  - GET  /voice/<filename> - 音声ファイル配信")
     print("  - GET  /health - ヘルスチェック")
+    print("  - GET  /metrics - メトリクス（Prometheus形式）")
     
     # ポート設定（Render等のクラウド環境対応）
     port = int(os.getenv('PORT', 5000))
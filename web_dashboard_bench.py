@@ -0,0 +1,369 @@
+"""AquaSync Webダッシュボード 負荷ベンチマーク
+
+web_dashboard.app に、ページ閲覧・/api/data のポーリング・センサーからの更新・
+画像と音声の取得を混ぜた負荷をかけ、ルートごとのスループットと
+p50/p95/p99 レイテンシを計測する。
+
+    python web_dashboard_bench.py inprocess [--duration 10] [--viewers 5] [--pollers 20]
+    python web_dashboard_bench.py gunicorn [--workers 1,2,4] [--worker-class gthread] [--threads 8]
+
+inprocess はFlaskのテストクライアントでアプリを直接呼び（HTTP・WSGIサーバーなし）、
+gunicorn はワーカー設定ごとにサーバーを起動してkeep-aliveのHTTP接続で計測する。
+--json で結果を保存し、--baseline に以前の結果を渡すとルートごとの差を表示する。
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import http.client
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+from local_sensor_bench import percentile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+API_KEY = 'bench'
+ASSET_PATHS = ('/img/yousei1.png', '/img/yousei4.png', '/img/back.jpg', '/voice/nice.wav', '/voice/omizu.wav')
+STATUSES = ('red', 'yellow', 'green')
+
+def route_of(path):
+    """集計用のルート名"""
+    if path.startswith('/img/'):
+        return '/img/<filename>'
+    if path.startswith('/voice/'):
+        return '/voice/<filename>'
+    return path.split('?')[0]
+
+def make_reading(rng):
+    """センサーから届く形の読み取り値"""
+    percentage = rng.randint(0, 100)
+    return {
+        'raw_value': percentage * 10,
+        'percentage': percentage,
+        'status': rng.choice(STATUSES),
+        'message': f'ベンチマーク {percentage}%',
+        'character_message': f'{percentage}%だよ〜',
+        'character_face': 'yousei2',
+        'timestamp': time.time(),
+    }
+
+class TestClientTransport:
+    """Flaskのテストクライアントでアプリを直接呼ぶ（1クライアントに1つ）"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers, body=None):
+        response = self.client.open(path, method=method, headers=headers, data=body)
+        response.get_data()
+        return response.status_code, response.headers.get('ETag')
+
+    def close(self):
+        pass
+
+class HTTPTransport:
+    """keep-aliveのHTTP接続1本（切れたら1回だけつなぎ直す）"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.conn = None
+
+    def request(self, method, path, headers, body=None):
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                response.read()
+                return response.status, response.getheader('ETag')
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+def run_client(role, transport, load, seed, start_at):
+    """1クライアント分の負荷をかけ、(ルート, 開始時刻, 所要秒数, ステータス) のリストを返す
+
+    writer は --write-rate 件/秒で更新を送り、それ以外は応答を受けたらすぐ
+    （--think 秒おいて）次を送る。viewer と poller はブラウザと同じくETagで再検証する。
+    """
+    rng = random.Random(seed)
+    etags = {}
+    samples = []
+    deadline = start_at + load['warmup'] + load['duration']
+    write_interval = 1.0 / load['write_rate'] if load['write_rate'] else 0
+    next_write = start_at
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        method, body = 'GET', None
+        headers = {}
+        if role == 'viewer':
+            path = '/'
+        elif role == 'poller':
+            path = '/api/data'
+        elif role == 'assets':
+            path = rng.choice(ASSET_PATHS)
+        else:
+            path, method = '/api/update', 'POST'
+            body = json.dumps(make_reading(rng)).encode('utf-8')
+            headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {API_KEY}'}
+        if load['conditional'] and path in etags:
+            headers['If-None-Match'] = etags[path]
+
+        started = time.perf_counter()
+        try:
+            status, etag = transport.request(method, path, headers, body)
+        except Exception:
+            status, etag = 0, None
+        elapsed = time.perf_counter() - started
+        samples.append((route_of(path), started - start_at, elapsed, status))
+        if etag and role in ('viewer', 'poller'):
+            etags[path] = etag
+
+        if role == 'writer':
+            next_write += write_interval
+            time.sleep(max(0.0, next_write - time.perf_counter()))
+        elif load['think']:
+            time.sleep(load['think'])
+    transport.close()
+    return samples
+
+def build_roles(args):
+    """負荷の内訳（クライアントごとの役割）"""
+    roles = ['writer'] if args.write_rate > 0 else []
+    roles += ['viewer'] * args.viewers + ['poller'] * args.pollers + ['assets'] * args.asset_clients
+    return roles
+
+def load_settings(args):
+    return {
+        'duration': args.duration,
+        'warmup': args.warmup,
+        'think': args.think,
+        'write_rate': args.write_rate,
+        'conditional': not args.no_conditional,
+        'viewers': args.viewers,
+        'pollers': args.pollers,
+        'asset_clients': args.asset_clients,
+    }
+
+def run_threads(roles, make_transport, load, seed):
+    """役割ごとにスレッドを立てて同時に負荷をかける"""
+    start_at = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(roles)) as pool:
+        futures = [pool.submit(run_client, role, make_transport(), load, seed + index, start_at)
+                   for index, role in enumerate(roles)]
+        samples = []
+        for future in futures:
+            samples.extend(future.result())
+    return samples
+
+def run_http_group(host, port, roles, load, seed):
+    """別プロセスで実行するHTTPクライアント群（負荷生成側がGILで詰まらないように分ける）"""
+    return run_threads(roles, lambda: HTTPTransport(host, port), load, seed)
+
+def summarize(samples, load):
+    """ウォームアップ後のサンプルをルートごとにまとめる"""
+    by_route = {}
+    for route, started, elapsed, status in samples:
+        if started >= load['warmup']:
+            by_route.setdefault(route, []).append((elapsed, status))
+
+    routes = {}
+    total = 0
+    for route, entries in sorted(by_route.items()):
+        latencies = [elapsed for elapsed, _ in entries]
+        statuses = Counter(str(status) for _, status in entries)
+        total += len(entries)
+        routes[route] = {
+            'requests': len(entries),
+            'rps': len(entries) / load['duration'],
+            'errors': sum(count for status, count in statuses.items() if status == '0' or status >= '500'),
+            'statuses': dict(sorted(statuses.items())),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': max(latencies) * 1000,
+        }
+    return {'total_rps': total / load['duration'], 'routes': routes}
+
+def print_run(run, baseline=None):
+    print(f"🧪 {run['label']}  合計 {run['total_rps']:,.0f} req/s")
+    print(f"  {'route':<18}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}  内訳")
+    for route, stats in run['routes'].items():
+        statuses = ' '.join(f"{status}:{count}" for status, count in stats['statuses'].items())
+        line = (f"  {route:<18}{stats['rps']:>10,.1f}{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}"
+                f"{stats['p99_ms']:>9.2f}{stats['max_ms']:>9.1f}  {statuses}")
+        previous = (baseline or {}).get('routes', {}).get(route)
+        if previous and previous['rps']:
+            line += (f"  (req/s x{stats['rps'] / previous['rps']:.2f},"
+                     f" p99 {stats['p99_ms'] - previous['p99_ms']:+.2f}ms)")
+        print(line)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def finish(args, mode, runs):
+    """結果の表示と保存"""
+    baseline_runs = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        baseline_runs = {run['label']: run for run in baseline.get('runs', [])}
+        print(f"📏 比較対象: {args.baseline} (commit {baseline.get('commit')})")
+    for run in runs:
+        print_run(run, baseline_runs.get(run['label']))
+
+    results = {
+        'commit': git_commit(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'mode': mode,
+        'load': load_settings(args),
+        'runs': runs,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"💾 結果を保存: {args.json}")
+    return results
+
+def bench_inprocess(args):
+    workdir = tempfile.mkdtemp(prefix='aquasync-web-bench-')
+    # web_dashboard は読み込み時に設定を読むので先に環境変数を設定する
+    os.environ.update({
+        'API_SECRET_KEY': API_KEY,
+        'DASHBOARD_DB_PATH': '' if args.no_db else os.path.join(workdir, 'dashboard.db'),
+        'IMAGE_VARIANTS_AUTOBUILD': 'false',
+        'STATE_BACKEND': 'memory',
+    })
+    import web_dashboard
+
+    load = load_settings(args)
+    roles = build_roles(args)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        samples = run_threads(roles, lambda: TestClientTransport(web_dashboard.app), load, args.seed)
+    run = dict(label='inprocess', config={'clients': len(roles)}, **summarize(samples, load))
+    return finish(args, 'inprocess', [run])
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_until_ready(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited during startup')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not become ready')
+
+def bench_gunicorn(args):
+    load = load_settings(args)
+    roles = build_roles(args)
+    groups = [roles[index::args.client_procs] for index in range(args.client_procs)]
+    groups = [group for group in groups if group]
+    runs = []
+    for workers in [int(value) for value in args.workers.split(',')]:
+        workdir = tempfile.mkdtemp(prefix='aquasync-web-bench-')
+        port = free_port()
+        env = dict(
+            os.environ,
+            API_SECRET_KEY=API_KEY,
+            WEB_CONCURRENCY=str(workers),
+            GUNICORN_WORKER_CLASS=args.worker_class,
+            GUNICORN_THREADS=str(args.threads),
+            DASHBOARD_DB_PATH='' if args.no_db else os.path.join(workdir, 'dashboard.db'),
+            STATE_MMAP_PATH=os.path.join(workdir, 'state'),
+            IMAGE_VARIANTS_AUTOBUILD='false',
+        )
+        log_path = os.path.join(workdir, 'gunicorn.log')
+        label = f"gunicorn-{args.worker_class}-w{workers}" + (f"-t{args.threads}" if args.worker_class == 'gthread' else '')
+        print(f"🚀 {label} を起動中 (port {port}, ログ {log_path})")
+        with open(log_path, 'w') as log:
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', '-c', os.path.join(BASE_DIR, 'gunicorn.conf.py'),
+                 '-b', f'127.0.0.1:{port}', 'web_dashboard:app'],
+                cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+            )
+        try:
+            wait_until_ready(port, process)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=len(groups)) as pool:
+                futures = [pool.submit(run_http_group, '127.0.0.1', port, group, load, args.seed + index * 1000)
+                           for index, group in enumerate(groups)]
+                samples = [sample for future in futures for sample in future.result()]
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        config = {'workers': workers, 'worker_class': args.worker_class, 'threads': args.threads,
+                  'clients': len(roles), 'client_procs': len(groups)}
+        runs.append(dict(label=label, config=config, **summarize(samples, load)))
+    return finish(args, 'gunicorn', runs)
+
+def add_load_arguments(command):
+    command.add_argument('--duration', type=float, default=10.0, help='計測時間（秒）')
+    command.add_argument('--warmup', type=float, default=1.0, help='集計から除く最初の秒数')
+    command.add_argument('--viewers', type=int, default=5, help='GET / を繰り返すクライアント数')
+    command.add_argument('--pollers', type=int, default=20, help='GET /api/data を繰り返すクライアント数')
+    command.add_argument('--asset-clients', type=int, default=2, help='画像・音声を取得するクライアント数')
+    command.add_argument('--write-rate', type=float, default=1.0, help='POST /api/update の頻度（件/秒、0で無効）')
+    command.add_argument('--think', type=float, default=0.0, help='各クライアントのリクエスト間隔（秒）')
+    command.add_argument('--no-conditional', action='store_true', help='ETagによる再検証（304）を使わない')
+    command.add_argument('--no-db', action='store_true', help='SQLiteへの履歴保存を無効にする')
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--baseline', help='比較する以前の結果（JSON）')
+    command.add_argument('--json', help='結果をJSONで保存するパス')
+
+def main():
+    parser = argparse.ArgumentParser(description='AquaSync Webダッシュボード 負荷ベンチマーク')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    inprocess_cmd = subparsers.add_parser('inprocess', help='テストクライアントでアプリを直接計測')
+    add_load_arguments(inprocess_cmd)
+    inprocess_cmd.set_defaults(func=bench_inprocess)
+
+    gunicorn_cmd = subparsers.add_parser('gunicorn', help='gunicornを起動してHTTP経由で計測')
+    add_load_arguments(gunicorn_cmd)
+    gunicorn_cmd.add_argument('--workers', default='1,2', help='ワーカー数（カンマ区切りで順に計測）')
+    gunicorn_cmd.add_argument('--worker-class', default='gthread', help='gthread / gevent / sync')
+    gunicorn_cmd.add_argument('--threads', type=int, default=8, help='gthread のスレッド数')
+    gunicorn_cmd.add_argument('--client-procs', type=int, default=min(4, os.cpu_count() or 1),
+                              help='負荷をかける側のプロセス数')
+    gunicorn_cmd.set_defaults(func=bench_gunicorn)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()